@@ -1,41 +1,473 @@
+import sys
+from startup_profile import StartupProfile
+# Created before any other import, so that --profile-startup can time them all
+startup = StartupProfile('--profile-startup' in sys.argv)
+
 import logging
 import os
-from PyQt4 import QtGui
+import threading
+from PyQt4 import QtGui, QtCore
 from PyQt4.Qt import Qt
 import h5py
-from pyqtgraph.dockarea import DockArea
+import numpy as np
 import re
-from plot_widgets import CrosshairPlotWidget, CloseableDock, CrossSectionDock, MoviePlotDock
-
-from scipy.stats import futil
-from scipy.sparse.csgraph import _validation
+from search_index import PathIndex, ShapeIndex
+from metadata import MetadataScanner, WorkspaceScanner, MetadataCache, cache_dir, AXIS_ATTRS
+from instrumentation import instruments, timed
+from reductions import StatisticsWorker, IOBudget, statistics_supported
+from workspace import FileHandles, is_workspace, workspace_files, file_labels
+# The plotting stack (pyqtgraph, plot_widgets, data_sources, scipy) is imported when the first plot is made
 
 
 class H5File(QtGui.QStandardItemModel):
-    def __init__(self, file=None):
+    """
+    The hierarchy is scanned on a background thread: top level rows and the search index are filled in
+    as batches arrive, deeper rows are loaded when expanded. When the file is refreshed, searches use the old index
+    until the new scan has finished.
+    With a MetadataCache, an unchanged file is not scanned again but restored from the cache. Files should then be
+    opened with its open_file(), and closed with close(), so that the viewer's own changes to their mtime are ignored.
+    Dataset statistics are computed in the background once their columns are shown, and kept until a refresh.
+    """
+    file_refreshed = QtCore.pyqtSignal()
+    scan_progress = QtCore.pyqtSignal(int)
+    scan_finished = QtCore.pyqtSignal(int)
+    # Around a rename of the indexes, which waits for their lock
+    renaming_paths = QtCore.pyqtSignal()
+    paths_renamed = QtCore.pyqtSignal()
+
+    def __init__(self, file=None, metadata_cache=None):
         super(H5File, self).__init__()
+        self.scanner = None
+        self.path_index = self.shape_index = None
+        self.metadata_cache = metadata_cache
+        self.statistics_worker = StatisticsWorker(IOBudget(STATISTICS_IO_BUDGET))
+        self.statistics_worker.statistics_computed.connect(self.statistics_computed)
         if file is not None:
             self.set_file(file)
 
+    @timed('H5File.set_file')
     def set_file(self, file):
         self.file = file
+        self.retired_files = []
+        # The file handle each open plot reads from, by id of its item
+        self.plotted_files = {}
         self.clear()
-        self.setColumnCount(2)
-        for k in file.keys():
-            item = h5_dispatch(file[k])
-            self.invisibleRootItem().appendRow(item)
+        self.setColumnCount(len(COLUMN_NAMES))
+        self.setHorizontalHeaderLabels(COLUMN_NAMES)
+        self.named_children = {}
+        self.path_index = self.shape_index = None
+        self.clear_statistics()
+        self.start_scan()
+
+    def start_index(self, path_index, shape_index):
+        'indexes a scan into path_index and shape_index, used once it finishes or straight away if there are none yet'
+        self.scan_path_index = path_index
+        self.scan_shape_index = shape_index
+        if self.path_index is None:
+            self.path_index, self.shape_index = path_index, shape_index
+
+    def start_scan(self):
+        if self.scanner is not None:
+            self.scanner.stop()
+            self.scanner.batch_scanned.disconnect()
+            self.scanner.scan_finished.disconnect()
+            self.scanner = None
+        self.scanned = 0
+        self.scanned_nodes = []
+        self.scan_key = None
+        if self.metadata_cache is not None:
+            try:
+                index = self.metadata_cache.load_index(self.file.filename)
+                if index is not None:
+                    self.start_index(index, ShapeIndex())
+                    for path, shape in self.metadata_cache.load_shapes(self.file.filename):
+                        self.scan_shape_index.add(path, shape)
+                    self.add_rows(self.metadata_cache.load_nodes(self.file.filename, depth=1))
+                    self.scanned = len(index)
+                    self.finish_scan(self.scanned)
+                    return
+                self.scan_key = self.metadata_cache.current_key(self.file.filename)
+            except Exception:
+                logging.exception("Could not read the metadata cache for %s", self.file.filename)
+        self.start_index(PathIndex(), ShapeIndex())
+        self.scanning = True
+        self.scanner = MetadataScanner(self.file)
+        self.scanner.batch_scanned.connect(self.add_scanned)
+        self.scanner.scan_finished.connect(self.finish_scan)
+        self.scanner.start()
+
+    def add_scanned(self, batch):
+        for node in batch:
+            self.scan_path_index.add(node.path)
+            self.scan_shape_index.add(node.path, node.shape)
+            for k in node.attrs:
+                if k not in H5_AXIS_ATTRS:
+                    self.scan_path_index.add(node.path + '/' + k)
+        self.add_rows(batch)
+        if self.scan_key is not None:
+            self.scanned_nodes.extend(batch)
+        self.scanned += len(batch)
+        self.scan_progress.emit(self.scanned)
+
+    def add_rows(self, nodes):
+        'creates the top level rows for the nodes which are directly below the root'
+        root = self.invisibleRootItem()
+        for node in nodes:
+            name = node.path[1:]
+            if '/' not in name and name not in self.named_children:
+                items = h5_dispatch(self.file[name])
+                insert_sorted(root, items)
+                self.named_children[name] = items[0]
+
+    def finish_scan(self, count):
+        self.scanning = False
+        self.path_index, self.shape_index = self.scan_path_index, self.scan_shape_index
+        if self.scan_key is not None:
+            thread = threading.Thread(target=self.store_scan, args=(self.scan_key, self.scanned_nodes, self.path_index))
+            thread.daemon = True
+            thread.start()
+            self.scan_key = None
+            self.scanned_nodes = []
+        self.scan_finished.emit(count)
+
+    def store_scan(self, file_key, nodes, path_index):
+        try:
+            self.metadata_cache.store(file_key, nodes, path_index)
+        except Exception:
+            logging.exception("Could not write the metadata cache for %s", file_key[0])
 
     def refresh(self):
-        filename = self.file.filename
-        self.file.close()
-        self.set_file(h5py.File(filename))
+        """
+        reopens the file and updates only the loaded rows which changed, keeping expansion and plots.
+        The old handle is closed first, so that the new one sees the file as it is now, unless open plots still
+        read from it. It is then closed once the last of them is closed.
+        """
+        old = self.file
+        filename, mode, swmr = old.filename, old.mode, getattr(old, 'swmr_mode', False)
+        if self.scanner is not None:
+            self.scanner.stop()
+        self.clear_statistics()
+        self.retired_files.append(old)
+        self.release_file(old)
+        if swmr:
+            self.file = self.open_file(filename, 'r', libver='latest', swmr=True)
+        else:
+            self.file = self.open_file(filename, mode)
+        self.update_rows(self.invisibleRootItem(), self.file, self.named_children)
+        self.start_scan()
+        self.file_refreshed.emit()
+
+    def open_file(self, filename, mode, **kwargs):
+        if self.metadata_cache is None:
+            return h5py.File(filename, mode, **kwargs)
+        return self.metadata_cache.open_file(filename, mode, **kwargs)
+
+    def close_file(self, f):
+        if self.metadata_cache is None:
+            f.close()
+        else:
+            self.metadata_cache.close_file(f)
+
+    def release_file(self, f):
+        'closes a handle replaced by refresh() once no plot reads from it'
+        if any(g is f for g in self.plotted_files.values()):
+            return
+        self.retired_files = [g for g in self.retired_files if g is not f]
+        self.close_file(f)
+
+    def close(self):
+        'closes the file, and the handles replaced by refreshing it'
+        if self.scanner is not None:
+            self.scanner.stop()
+        for f in self.retired_files + [self.file]:
+            self.close_file(f)
+        self.retired_files = []
+
+    def writable(self, item):
+        'whether the file of item was opened for writing, files followed with SWMR are only read'
+        return self.file.mode == 'r+'
+
+    def file_modified(self, item):
+        'called when the viewer writes to the file of item, so its cache entry is no longer trusted'
+        if self.metadata_cache is not None:
+            self.metadata_cache.file_modified(item.group.file.filename)
+
+    def update_rows(self, parent, group, named_children, named_attrs=None):
+        'brings the loaded rows below parent in line with group, recursing only into populated rows'
+        keys = set(group.keys())
+        for k in list(named_children):
+            child = group.get(k) if k in keys else None
+            if child is None or isinstance(child, h5py.Group) != isinstance(named_children[k].group, h5py.Group):
+                parent.removeRow(QtGui.QStandardItem.row(named_children.pop(k)))
+            else:
+                named_children[k].rebind(child)
+        parent_junk = parent.junk if isinstance(parent, H5Item) else False
+        parent_name = parent.fullname if isinstance(parent, H5Item) else ''
+        for k in keys.difference(named_children):
+            items = h5_dispatch(group[k])
+            items[0].propagate_junk(parent_junk)
+            for c in items:
+                c.update_fullname(parent_name)
+            insert_sorted(parent, items)
+            named_children[k] = items[0]
+
+        if named_attrs is None:
+            return
+        attr_keys = set(k for k in group.attrs.keys() if k not in H5_AXIS_ATTRS)
+        for k in list(named_attrs):
+            if k in attr_keys:
+                named_attrs[k].row.rebind(group)
+            else:
+                parent.removeRow(QtGui.QStandardItem.row(named_attrs.pop(k)))
+        for k in attr_keys.difference(named_attrs):
+            columns = H5AttrRow(k, group).columns
+            for c in columns:
+                c.update_fullname(parent_name)
+            insert_sorted(parent, columns)
+            named_attrs[k] = columns[0]
+
+    def hasChildren(self, index=QtCore.QModelIndex()):
+        item = self.itemFromIndex(index)
+        if isinstance(item, H5ItemName) and not item.populated:
+            return item.has_h5_children()
+        return super(H5File, self).hasChildren(index)
+
+    def canFetchMore(self, index):
+        item = self.itemFromIndex(index)
+        return isinstance(item, H5ItemName) and not item.populated
+
+    def fetchMore(self, index):
+        item = self.itemFromIndex(index)
+        if isinstance(item, H5ItemName):
+            item.populate()
+
+    def loaded_items(self, path):
+        'returns the items already loaded for a path, without loading anything'
+        parent = None
+        children = self.named_children
+        names = path.strip('/').split('/')
+        for name in names[:-1]:
+            parent = children.get(name)
+            if parent is None or not parent.populated:
+                return []
+            children = parent.named_children
+        items = [children.get(names[-1])]
+        if parent is not None:
+            items.append(parent.named_attrs.get(names[-1]))
+        return [i for i in items if i is not None]
+
+    def clear_statistics(self):
+        self.statistics_worker.cancel()
+        self.statistics = {}
+        self.statistics_pending = set()
+
+    def get_statistics(self, item):
+        'the Statistics of the dataset of an item, or None while they are being computed or if that failed'
+        path = item.fullname
+        if path not in self.statistics and path not in self.statistics_pending:
+            self.statistics_pending.add(path)
+            self.statistics_worker.request(path, item.group)
+        return self.statistics.get(path)
+
+    def statistics_computed(self, path, stats):
+        if path not in self.statistics_pending:
+            return
+        self.statistics_pending.discard(path)
+        self.statistics[path] = stats
+        for item in self.loaded_items(path):
+            if isinstance(item.row, H5DatasetRow):
+                item.row.statistics_changed()
+
+    def plot_opened(self, item):
+        'called while a plot reads from the dataset of item, whose file handle is then kept open'
+        self.plotted_files[id(item)] = self.file
+
+    def plot_closed(self, item):
+        f = self.plotted_files.pop(id(item), None)
+        if f is not None and any(g is f for g in self.retired_files):
+            self.release_file(f)
+
+    def get_object(self, path):
+        return self.file[path]
+
+    def same_file(self, path_1, path_2):
+        return True
+
+    def find_paths(self, terms):
+        'returns the paths of every node whose full name contains all of the given terms, as far as scanned'
+        return self.path_index.search(terms)
+
+    def path_renamed(self, old_path, new_path):
+        # Searches in progress give up the lock rather than have the GUI thread wait for them
+        self.renaming_paths.emit()
+        for index in set([self.path_index, self.scan_path_index, self.shape_index, self.scan_shape_index]):
+            index.rename(old_path, new_path)
+        for p in list(self.statistics):
+            if p == old_path or p.startswith(old_path + '/'):
+                self.statistics[new_path + p[len(old_path):]] = self.statistics.pop(p)
+        self.paths_renamed.emit()
+
+
+class H5Workspace(H5File):
+    """
+    The HDF5 files in a directory or matching a glob pattern, with a top level row for each.
+    The files are scanned in parallel on a pool of processes, into one search index of paths below their rows.
+    A file is only opened once its row is expanded, and at most MAX_OPEN_FILES are kept open:
+    the least recently used file without an open plot is closed, and its rows unloaded.
+    """
+    def __init__(self, pattern, metadata_cache=None, swmr=False):
+        super(H5Workspace, self).__init__(None, metadata_cache)
+        self.pattern = pattern
+        self.handles = FileHandles(MAX_OPEN_FILES, on_close=self.file_closed, swmr=swmr, metadata_cache=metadata_cache)
+        self.plotted_files = {}
+        self.set_files(workspace_files(pattern))
+
+    def set_files(self, filenames):
+        self.file = None
+        self.clear()
+        self.setColumnCount(len(COLUMN_NAMES))
+        self.setHorizontalHeaderLabels(COLUMN_NAMES)
+        self.named_children = {}
+        self.file_items = {}
+        self.path_index = self.shape_index = None
+        self.clear_statistics()
+        self.add_files(filenames)
+        self.start_scan()
+
+    def add_files(self, filenames):
+        root = self.invisibleRootItem()
+        taken = set(self.named_children)
+        for filename, label in sorted(file_labels(filenames).items()):
+            while label in taken:
+                label += '_'
+            taken.add(label)
+            item = H5FileItem(filename, label, self.handles)
+            insert_sorted(root, [item])
+            self.named_children[label] = item
+            self.file_items[filename] = item
+
+    def start_scan(self):
+        if self.scanner is not None:
+            self.scanner.stop()
+            self.scanner.file_scanned.disconnect()
+            self.scanner.scan_finished.disconnect()
+            self.scanner = None
+        self.scanned = 0
+        self.scanned_nodes = []
+        self.scan_key = None
+        self.start_index(PathIndex(['/' + label for label in self.named_children]), ShapeIndex())
+        self.scanning = True
+        if self.metadata_cache is not None:
+            db_path = self.metadata_cache.db_path
+            files = [(item.name, fn, self.metadata_cache.current_key(fn)) for fn, item in self.file_items.items()]
+        else:
+            db_path = None
+            files = [(item.name, fn, None) for fn, item in self.file_items.items()]
+        self.scanner = WorkspaceScanner(files, db_path)
+        self.scanner.file_scanned.connect(self.add_file_nodes)
+        self.scanner.scan_finished.connect(self.finish_scan)
+        self.scanner.start()
+
+    def add_file_nodes(self, label, nodes):
+        prefix = '/' + label
+        for node in nodes:
+            self.scan_path_index.add(prefix + node.path)
+            self.scan_shape_index.add(prefix + node.path, node.shape)
+            for k in node.attrs:
+                if k not in H5_AXIS_ATTRS:
+                    self.scan_path_index.add(prefix + node.path + '/' + k)
+        self.scanned += len(nodes)
+        self.scan_progress.emit(self.scanned)
+
+    def refresh(self):
+        'picks up files added to or removed from the workspace, and updates the loaded rows of the others'
+        filenames = workspace_files(self.pattern)
+        root = self.invisibleRootItem()
+        for filename in set(self.file_items).difference(filenames):
+            item = self.file_items.pop(filename)
+            del self.named_children[item.name]
+            root.removeRow(QtGui.QStandardItem.row(item))
+            self.handles.close(filename)
+        self.add_files([fn for fn in filenames if fn not in self.file_items])
+        self.clear_statistics()
+        for item in self.file_items.values():
+            if item.populated:
+                item.rebind(self.handles.reopen(item.filename))
+        self.start_scan()
+        self.file_refreshed.emit()
+
+    def close(self):
+        if self.scanner is not None:
+            self.scanner.stop()
+        self.handles.close_all()
+
+    def file_closed(self, filename):
+        item = self.file_items.get(filename)
+        if item is not None:
+            item.unload()
+
+    def file_item(self, item):
+        'the row of the file containing item'
+        return self.named_children.get(item.fullname.split('/')[1])
+
+    def get_object(self, path):
+        label, _, rest = path.lstrip('/').partition('/')
+        return self.named_children[label].group['/' + rest]
+
+    def same_file(self, path_1, path_2):
+        return path_1.split('/')[1] == path_2.split('/')[1]
+
+    def writable(self, item):
+        f = self.handles.files.get(self.file_item(item).filename)
+        if f is None:
+            # Opened for writing when used, if it can be
+            return not self.handles.swmr
+        return f.mode == 'r+'
+
+    def plot_opened(self, item):
+        # Remembered, the file's row may be gone by the time the plot is closed
+        filename = self.plotted_files[id(item)] = self.file_item(item).filename
+        self.handles.pin(filename)
+
+    def plot_closed(self, item):
+        filename = self.plotted_files.pop(id(item), None)
+        if filename is not None:
+            self.handles.unpin(filename)
+
+
+COLUMN_NAMES = ["Name", "Shape", "Min", "Max", "Mean", "NaNs", "Histogram"]
+
+# These are set by h5py for axis handling
+H5_AXIS_ATTRS = AXIS_ATTRS
+
+
+def insert_sorted(parent, columns):
+    'inserts a row into a parent whose rows are already in natural order, keeping that order'
+    key = columns[0].sort_key
+    lo, hi = 0, parent.rowCount()
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key < parent.child(mid).sort_key:
+            hi = mid
+        else:
+            lo = mid + 1
+    parent.insertRow(lo, columns)
+
+
+def editable_flags(item):
+    'the flags of a row which can be renamed or edited, unless its file is only being read'
+    model = item.model()
+    if model is not None and not model.writable(item):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+    return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
 
 
 def h5_dispatch(item):
-    if isinstance(item, h5py.Group):
-        return H5ItemName(item)
-    else:
+    if isinstance(item, h5py.Dataset):
         return H5DatasetRow(item).columns
+    else:
+        # Groups, and committed datatypes which only have attributes below them
+        return [H5ItemName(item)]
 
 
 class H5Item(QtGui.QStandardItem):
@@ -45,20 +477,11 @@ class H5Item(QtGui.QStandardItem):
         self.row = row
         self.fullname = group.name
         self.name = group.name.split('/')[-1]
+        self.sort_key = natural_keys(self.name)
         self.marked_junk = False
-
-        for k in group.attrs.keys():
-            if k in ('DIMENSION_SCALE', 'DIMENSION_LIST', 'CLASS', 'NAME', 'REFERENCE_LIST'):
-                # These are set by h5py for axis handling
-                continue
-            if k == "__JUNK__":
-                self.marked_junk = group.attrs[k]
-            self.appendRow(H5AttrRow(k, group).columns)
-
-        if isinstance(group, h5py.Group):
-            for k in group.keys():
-                items = h5_dispatch(group[k])
-                self.appendRow(items)
+        if "__JUNK__" in group.attrs:
+            self.marked_junk = group.attrs["__JUNK__"]
+        self.junk = bool(self.marked_junk)
 
     def data(self, role):
         if role == Qt.BackgroundRole and self.row and self.row.plot is not None:
@@ -67,10 +490,24 @@ class H5Item(QtGui.QStandardItem):
             return super(H5Item, self).data(role)
 
     def is_junk(self):
-        p = self.parent()
-        if p is None:
-            return self.marked_junk
-        return self.marked_junk or p.is_junk()
+        return self.junk
+
+    def propagate_junk(self, parent_junk=False):
+        'recomputes the cached junk flag of this node and of its loaded descendants'
+        self.junk = bool(self.marked_junk or parent_junk)
+        for r in range(self.rowCount()):
+            child = self.child(r, 0)
+            if isinstance(child, H5Item):
+                child.propagate_junk(self.junk)
+
+    def update_fullname(self, parent_name):
+        'follows a rename of this node or one of its ancestors, for the rows already loaded'
+        self.fullname = parent_name + '/' + self.name
+        for r in range(self.rowCount()):
+            for c in range(self.columnCount()):
+                child = self.child(r, c)
+                if child is not None:
+                    child.update_fullname(self.fullname)
 
 
 class H5ItemName(H5Item):
@@ -78,6 +515,60 @@ class H5ItemName(H5Item):
         #name = group.name.split('/')[-1]
         super(H5ItemName, self).__init__(group, row)
         self.setText(str(self.name))
+        self.populated = False
+        self.named_children = {}
+        self.named_attrs = {}
+
+    def rebind(self, group):
+        'points this row at the same node in a reopened file, updating what changed'
+        self.group = group
+        marked_junk = group.attrs.get("__JUNK__", False)
+        if bool(marked_junk) != bool(self.marked_junk):
+            self.marked_junk = marked_junk
+            parent = self.parent()
+            self.propagate_junk(parent.junk if parent is not None else False)
+            self.emitDataChanged()
+        if self.row is not None:
+            self.row.shape.group = group
+            shape = str(group.shape)
+            if shape != str(self.row.shape.text()):
+                self.row.shape.setText(shape)
+            self.row.statistics_changed()
+        if self.populated:
+            self.model().update_rows(self, group, self.named_children, self.named_attrs)
+
+    def has_h5_children(self):
+        'whether populate() would add any rows, axis attributes are not shown'
+        if isinstance(self.group, h5py.Group) and len(self.group) > 0:
+            return True
+        return any(k not in H5_AXIS_ATTRS for k in self.group.attrs)
+
+    def populate(self):
+        'creates the rows for this node\'s attributes and children, one level deep'
+        if self.populated:
+            return
+        self.populated = True
+        rows = []
+        for k in self.group.attrs.keys():
+            if k in H5_AXIS_ATTRS:
+                continue
+            columns = H5AttrRow(k, self.group).columns
+            self.named_attrs[k] = columns[0]
+            rows.append(columns)
+
+        if isinstance(self.group, h5py.Group):
+            for k in self.group.keys():
+                items = h5_dispatch(self.group[k])
+                items[0].propagate_junk(self.junk)
+                self.named_children[k] = items[0]
+                rows.append(items)
+
+        # Rows are kept in natural order in the source model, so the proxies never have to sort
+        for columns in sorted(rows, key=lambda columns: columns[0].sort_key):
+            # Paths within the file, prefixed with the file's row in a workspace
+            for c in columns:
+                c.update_fullname(self.fullname)
+            self.appendRow(columns)
 
     def setData(self, value, role):
         if role != Qt.EditRole:
@@ -94,15 +585,74 @@ class H5ItemName(H5Item):
             parent_group = self.group.file
         else:
             parent_group = self.parent().group
+        self.model().file_modified(self)
         parent_group[name] = self.group
         self.group = parent_group[name]
         del parent_group[self.name]
+        model = self.model()
+        parent = self.parent()
+        if parent is None:
+            siblings = model.named_children
+            parent = model.invisibleRootItem()
+        else:
+            siblings = parent.named_children
+        siblings[name] = siblings.pop(self.name)
         self.name = name
+        self.sort_key = natural_keys(name)
+        old_fullname = self.fullname
+        parent_name = old_fullname.rsplit('/', 1)[0]
+        self.update_fullname(parent_name)
+        if self.row is not None:
+            self.row.shape.name = name
+            self.row.shape.update_fullname(parent_name)
+        model.path_renamed(old_fullname, self.fullname)
         self.setText(name)
-        self.emitDataChanged()
+        insert_sorted(parent, parent.takeRow(QtGui.QStandardItem.row(self)))
 
     def flags(self):
-        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+        return editable_flags(self)
+
+
+class H5FileItem(H5ItemName):
+    """
+    The top level row of a file in a workspace. The file is only opened, through the workspace's FileHandles,
+    when it is used, and may be closed again, unloading the rows below.
+    """
+    def __init__(self, filename, label, handles):
+        QtGui.QStandardItem.__init__(self, label)
+        self.filename = filename
+        self.handles = handles
+        self.row = None
+        self.name = label
+        self.fullname = '/' + label
+        self.sort_key = natural_keys(label)
+        self.marked_junk = False
+        self.junk = False
+        self.populated = False
+        self.named_children = {}
+        self.named_attrs = {}
+        self.setToolTip(filename)
+
+    @property
+    def group(self):
+        return self.handles.get(self.filename)
+
+    @group.setter
+    def group(self, group):
+        # Always taken from the handles, which rebind() has already reopened
+        pass
+
+    def has_h5_children(self):
+        return True
+
+    def unload(self):
+        self.removeRows(0, self.rowCount())
+        self.populated = False
+        self.named_children = {}
+        self.named_attrs = {}
+
+    def flags(self):
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
 
 
 class H5DatasetRow(object):
@@ -110,17 +660,70 @@ class H5DatasetRow(object):
         self.name = H5ItemName(dataset, self)
         self.shape = H5Item(dataset, self, text=str(dataset.shape))
         self.shape.setEditable(False)
+        self.statistics = [H5StatisticItem(self, field) for field in COLUMN_NAMES[2:]]
         self.plot = None
-        self.columns = [self.name, self.shape]
+        self.columns = [self.name, self.shape] + self.statistics
+
+    def statistics_changed(self):
+        for item in self.statistics:
+            if item.shown:
+                item.emitDataChanged()
+
+
+class H5StatisticItem(QtGui.QStandardItem):
+    'one statistic of a dataset, which is only computed once it is displayed'
+    SPARKS = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+
+    def __init__(self, row, field):
+        super(H5StatisticItem, self).__init__()
+        self.row = row
+        self.field = field
+        self.shown = False
+        self.setEditable(False)
+
+    def data(self, role):
+        if role == Qt.DisplayRole:
+            self.shown = True
+            dataset = self.row.name.group
+            if not statistics_supported(dataset):
+                return ''
+            model = self.model()
+            stats = model.get_statistics(self.row.name)
+            if stats is None:
+                # Kept as None when the dataset could not be read
+                return 'error' if self.row.name.fullname in model.statistics else '...'
+            return self.format(stats)
+        if role == Qt.ToolTipRole and self.field == "Histogram":
+            stats = self.model().statistics.get(self.row.name.fullname)
+            if stats is not None and stats.edges is not None:
+                return '\n'.join('%.4g to %.4g: %d' % (stats.edges[i], stats.edges[i + 1], c)
+                                  for i, c in enumerate(stats.histogram))
+        if role == Qt.BackgroundRole and self.row.plot is not None:
+            return QtGui.QBrush(QtGui.QColor(255, 0, 0, 127))
+        return super(H5StatisticItem, self).data(role)
+
+    def format(self, stats):
+        if self.field == "NaNs":
+            return str(stats.nan_count)
+        if not stats.count:
+            return ''
+        if self.field == "Histogram":
+            top = float(max(stats.histogram.max(), 1))
+            return u''.join(self.SPARKS[int(round(c / top * (len(self.SPARKS) - 1)))] for c in stats.histogram)
+        return '%.4g' % {"Min": stats.min, "Max": stats.max, "Mean": stats.mean}[self.field]
+
+    def update_fullname(self, parent_name):
+        pass
 
 class H5AttrItem(QtGui.QStandardItem):
     def __init__(self, key, group, row, text=""):
         super(H5AttrItem, self).__init__(text)
         self.key = key
+        self.group = group
         self.row = row
-        self.value = str(group.attrs[key])
         self.fullname = group.name + '/' + key
         self.name = key
+        self.sort_key = natural_keys(key)
 
     def data(self, role):
         if role == Qt.BackgroundRole:
@@ -129,11 +732,14 @@ class H5AttrItem(QtGui.QStandardItem):
             return super(H5AttrItem, self).data(role)
 
     def flags(self):
-        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+        return editable_flags(self)
 
     def is_junk(self):
         return self.parent().is_junk()
 
+    def update_fullname(self, parent_name):
+        self.fullname = parent_name + '/' + self.key
+
 
 class H5AttrKey(H5AttrItem):
     def __init__(self, key, group, row):
@@ -142,17 +748,43 @@ class H5AttrKey(H5AttrItem):
     def setData(self, value, role):
         if role != Qt.EditRole:
             return super(H5AttrKey, self).setData(value, role)
+        model = self.model()
+        model.file_modified(self)
         attr_val = self.group.attrs[self.key]
         del self.group.attrs[self.key]
-        self.key = str(value.toString())
+        parent = self.parent()
+        named_attrs = parent.named_attrs
+        named_attrs[str(value.toString())] = named_attrs.pop(self.key)
+        self.key = self.name = str(value.toString())
+        self.sort_key = natural_keys(self.key)
         self.group.attrs[self.key] = attr_val
+        old_fullname = self.fullname
+        parent_name = old_fullname.rsplit('/', 1)[0]
+        self.update_fullname(parent_name)
+        self.row.value.key = self.row.value.name = self.key
+        self.row.value.update_fullname(parent_name)
+        model.path_renamed(old_fullname, self.fullname)
+        self.setText(self.key)
+        insert_sorted(parent, parent.takeRow(QtGui.QStandardItem.row(self)))
 
 
 class H5AttrValue(H5AttrItem):
+    """
+    The value is only read from the file once the row is displayed, and then shown as a bounded preview.
+    The full value is read again when the row is edited.
+    """
     def __init__(self, key, group, row):
-        #value = str(group.attrs[key])
         super(H5AttrValue, self).__init__(key, group, row)
-        self.setText(self.value)
+        self.preview = None
+
+    def data(self, role):
+        if role == Qt.DisplayRole:
+            if self.preview is None:
+                self.preview = attr_preview(self.group.attrs[self.key])
+            return self.preview
+        if role == Qt.EditRole:
+            return str(self.group.attrs[self.key])
+        return super(H5AttrValue, self).data(role)
 
     def setData(self, value, role):
         if role != Qt.EditRole:
@@ -163,7 +795,22 @@ class H5AttrValue(H5AttrItem):
             v = value.toFloat()
         else:
             v = str(value.toString())
+        self.model().file_modified(self)
         self.group.attrs[self.key] = v
+        self.preview = None
+        self.emitDataChanged()
+
+
+def attr_preview(value, max_length=80, max_items=6):
+    'the value itself if it is short, else its dtype, shape and first few elements'
+    if isinstance(value, np.ndarray) and value.size > max_items:
+        items = ', '.join(str(v) for v in value.flat[:max_items])
+        text = '%s %s: [%s, ...]' % (value.dtype, value.shape, items)
+    else:
+        text = str(value)
+    if len(text) > max_length:
+        text = text[:max_length - 3] + '...'
+    return text
 
 
 class H5AttrRow(object):
@@ -172,6 +819,14 @@ class H5AttrRow(object):
         self.value = H5AttrValue(key, dataset, self)
         self.columns = [self.name, self.value]
 
+    def rebind(self, group):
+        self.name.group = self.value.group = group
+        if self.value.preview is not None:
+            preview = attr_preview(group.attrs[self.value.key])
+            if preview != self.value.preview:
+                self.value.preview = preview
+                self.value.emitDataChanged()
+
 class H5View(QtGui.QTreeView):
     def __init__(self):
         super(H5View, self).__init__()
@@ -207,9 +862,13 @@ class H5View(QtGui.QTreeView):
 
     def mark_node_junk(self):
         for i in self.selected_items():
+            self.model().sourceModel().file_modified(i)
             i.group.attrs["__JUNK__"] = True
             i.marked_junk = True
-        self.model().invalidateFilter()
+            if isinstance(i, H5Item):
+                i.propagate_junk(i.junk)
+                # Only this row needs re-filtering, hiding it hides its subtree
+                i.emitDataChanged()
 
     def set_valid_context_menu_actions(self):
         items = self.selected_items()
@@ -217,7 +876,8 @@ class H5View(QtGui.QTreeView):
         self.mark_junk_action.setEnabled(False)
         self.attach_x_axis_scale_action.setEnabled(False)
         self.attach_y_axis_scale_action.setEnabled(False)
-        if not items:
+        # Files followed with SWMR are opened read-only
+        if not items or not all(self.model().sourceModel().writable(i) for i in items):
             return
         self.mark_junk_action.setEnabled(True)
         if len(items) == 1 and isinstance(items[0].group, h5py.Dataset):
@@ -237,6 +897,7 @@ class H5View(QtGui.QTreeView):
         m = AxisSelectionModel(self.model().sourceModel(), i, axis_n)
         w = QtGui.QTreeView()
         w.setModel(m)
+        w.setRootIsDecorated(False)
         w.setSelectionMode(QtGui.QAbstractItemView.SingleSelection)
 
         dialog = QtGui.QDialog()
@@ -261,6 +922,7 @@ class H5View(QtGui.QTreeView):
                 print 'Non-Dataset selected'
                 return
 
+            self.model().sourceModel().file_modified(i)
             i.group.dims.create_scale(axis_item.group, axis_item.name)
             i.group.dims[axis_n].attach_scale(axis_item.group)
             print 'Successfully attached axis', axis_n
@@ -268,23 +930,38 @@ class H5View(QtGui.QTreeView):
 class TreeFilterModel(QtGui.QSortFilterProxyModel):
     def __init__(self, **kwargs):
         super(TreeFilterModel, self).__init__(**kwargs)
-        self.matching_items = []
+        self.setDynamicSortFilter(True)
+        self.matching_paths = None
 
     def itemFromIndex(self, idx):
         return self.sourceModel().itemFromIndex(self.mapToSource(idx))
 
-    def set_matches(self, matches):
-        matches = set(matches)
-        old_matches = None
-        root = self.sourceModel().invisibleRootItem()
-        while matches != old_matches:
-            old_matches = matches
-            matches = matches.union({i.parent() for i in old_matches})
-            matches = matches.difference({None, root})
-        self.matching_items = matches
-        self.invalidateFilter()
+    def set_matches(self, paths):
+        'accepts only the given paths and their ancestors, or everything if paths is None'
+        if paths is not None:
+            paths = ancestor_closure(paths)
+        self.apply_matches(paths)
+
+    def apply_matches(self, closed_paths):
+        old_paths = self.matching_paths
+        self.matching_paths = closed_paths
+        if old_paths is None or closed_paths is None:
+            self.invalidateFilter()
+            return
+        changed = old_paths.symmetric_difference(closed_paths)
+        if len(changed) > len(old_paths):
+            self.invalidateFilter()
+            return
+        # Re-filter only the rows whose acceptance changed, parents before children.
+        # With a dynamic sort filter, a dataChanged on a source row makes the proxy re-evaluate just that row.
+        source = self.sourceModel()
+        for path in sorted(changed, key=lambda p: p.count('/')):
+            for item in source.loaded_items(path):
+                item.emitDataChanged()
 
     def filterAcceptsRow(self, src_i, src_parent_index):
+        if instruments.enabled:
+            instruments.count('filterAcceptsRow')
         this_parent = self.sourceModel().itemFromIndex(src_parent_index)
         if this_parent:
             this_item = this_parent.child(src_i)
@@ -294,12 +971,21 @@ class TreeFilterModel(QtGui.QSortFilterProxyModel):
         return self.filter_accepts_item(this_item)
 
     def filter_accepts_item(self, item):
-        return item in self.matching_items
+        return self.matching_paths is None or item.fullname in self.matching_paths
 
     def lessThan(self, idx_1, idx_2):
         item_1 = self.sourceModel().itemFromIndex(idx_1)
         item_2 = self.sourceModel().itemFromIndex(idx_2)
-        return natural_keys(item_1.name) < natural_keys(item_2.name)
+        return item_1.sort_key < item_2.sort_key
+
+def ancestor_closure(paths):
+    'the paths together with all their ancestors, climbing from each path only until a known ancestor is hit'
+    closed = set()
+    for p in paths:
+        while p and p not in closed:
+            closed.add(p)
+            p = p.rsplit('/', 1)[0]
+    return closed
 
 def atoi(text):
     return int(text) if text.isdigit() else text
@@ -316,13 +1002,24 @@ class RecursiveFilterModel(TreeFilterModel):
     def setSourceModel(self, model):
         super(RecursiveFilterModel, self).setSourceModel(model)
         model.modelReset.connect(self.source_model_changed)
-
-    def get_matches(self, t):
-        items = self.sourceModel().findItems("", Qt.MatchContains | Qt.MatchRecursive)
-        x = [i for i in items if t in i.fullname]
-        return x
-        #return [i for i in items if t in i.fullname]
-        #return self.sourceModel().findItems(t, Qt.MatchContains | Qt.MatchRecursive)
+        model.file_refreshed.connect(self.source_model_changed)
+        # Matches found in newly scanned parts of the file, and in the new index once a refresh has been scanned
+        model.scan_progress.connect(self.source_model_changed)
+        model.scan_finished.connect(self.source_model_changed)
+        model.renaming_paths.connect(lambda: self.match_worker.cancel())
+        model.paths_renamed.connect(self.source_model_changed)
+        self.match_worker = MatchWorker(self.find_closed_matches)
+        self.match_worker.matches_found.connect(self.matches_found)
+
+    @timed('RecursiveFilterModel.find_closed_matches')
+    def find_closed_matches(self, terms, cancelled):
+        paths = self.sourceModel().path_index.search(terms, cancelled)
+        if paths is None or cancelled():
+            return None
+        return ancestor_closure(paths)
+
+    def get_matches(self, terms):
+        return self.sourceModel().find_paths(terms)
 
     def toggle_attrs_visible(self, checked):
         self.attrs_visible = checked
@@ -332,15 +1029,34 @@ class RecursiveFilterModel(TreeFilterModel):
         self.junk_visible = checked
         self.invalidateFilter()
 
-    def source_model_changed(self):
-        self.set_match_term(self.term_string)
+    def source_model_changed(self, *args):
+        if str(self.term_string).split():
+            self.request_match_term(self.term_string)
 
+    @timed('RecursiveFilterModel.set_match_term')
     def set_match_term(self, term_string):
         # Match all words
         self.term_string = term_string
-        matches = [set(self.get_matches(t)) for t in str(term_string).split()]
-        m0 = set(self.get_matches(""))
-        self.set_matches(m0.intersection(*matches))
+        self.match_worker.cancel()
+        terms = str(term_string).split()
+        if terms:
+            self.set_matches(self.get_matches(terms))
+        else:
+            self.set_matches(None)
+
+    def request_match_term(self, term_string):
+        'like set_match_term, but the matching runs in the background and only the newest term is applied'
+        self.term_string = term_string
+        terms = str(term_string).split()
+        if terms:
+            self.match_worker.submit(terms)
+        else:
+            self.match_worker.cancel()
+            self.set_matches(None)
+
+    def matches_found(self, terms, closed_paths):
+        if terms == str(self.term_string).split():
+            self.apply_matches(closed_paths)
 
     def filter_accepts_item(self, item):
         if not self.attrs_visible and isinstance(item, H5AttrItem):
@@ -350,15 +1066,73 @@ class RecursiveFilterModel(TreeFilterModel):
         return super(RecursiveFilterModel, self).filter_accepts_item(item)
 
 
-class AxisSelectionModel(TreeFilterModel):
+class AxisSelectionModel(QtGui.QStandardItemModel):
+    'the 1D datasets which fit an axis of a dataset, from the shape index of the model, closest ones first'
     def __init__(self, source_model, source, axis):
         super(AxisSelectionModel, self).__init__()
-        self.setSourceModel(source_model)
-        items = self.sourceModel().findItems("", Qt.MatchContains | Qt.MatchRecursive)
-        groups = [i for i in items if isinstance(i, H5Item) and i is not source]
-        datasets = [i for i in groups if isinstance(i.group, h5py.Dataset)]
-        self.set_matches([i for i in datasets if i.group.shape == (source.group.shape[axis],)])
-        self.sort(0)
+        self.setHorizontalHeaderLabels(["Dataset"])
+        for path in source_model.shape_index.candidates(source.group.shape[axis], near=source.fullname):
+            if path != source.fullname and source_model.same_file(path, source.fullname):
+                self.appendRow(AxisCandidateItem(source_model, path))
+
+
+class AxisCandidateItem(QtGui.QStandardItem):
+    'a candidate axis scale, which is only opened once chosen'
+    def __init__(self, source_model, path):
+        super(AxisCandidateItem, self).__init__(path)
+        self.setEditable(False)
+        self.source_model = source_model
+        self.fullname = path
+        self.name = path.split('/')[-1]
+
+    @property
+    def group(self):
+        return self.source_model.get_object(self.fullname)
+
+
+class MatchWorker(QtCore.QObject):
+    """
+    Runs match queries on a background thread. Submitting a query cancels the one in progress,
+    and only the result of the newest query is delivered, through matches_found.
+    """
+    matches_found = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, find_matches):
+        super(MatchWorker, self).__init__()
+        self.find_matches = find_matches
+        self.generation = 0
+        self.pending = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, terms):
+        with self.condition:
+            self.generation += 1
+            self.pending = (self.generation, terms)
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.pending = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+                generation, terms = self.pending
+                self.pending = None
+            cancelled = lambda: generation != self.generation
+            try:
+                result = self.find_matches(terms, cancelled)
+            except Exception:
+                logging.exception("Search for %s failed", terms)
+                continue
+            if result is not None and not cancelled():
+                self.matches_found.emit(terms, result)
 
 
 class SearchableH5View(QtGui.QWidget):
@@ -368,34 +1142,132 @@ class SearchableH5View(QtGui.QWidget):
         match_model = RecursiveFilterModel()
         match_model.setSourceModel(model)
         match_model.set_match_term("")
-        match_model.sort(0)
         self.tree_view = H5View()
         self.tree_view.setModel(match_model)
         layout.addWidget(self.tree_view)
         self.search_box = QtGui.QLineEdit()
         layout.addWidget(self.search_box)
-        self.search_box.textChanged.connect(match_model.set_match_term)
+        # Coalesce keystrokes, only searching once typing pauses
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(150)
+        self.search_timer.timeout.connect(lambda: match_model.request_match_term(self.search_box.text()))
+        self.search_box.textChanged.connect(self.search_timer.start)
+
+
+class InstrumentsDock(QtGui.QDockWidget):
+    'shows what the instruments have recorded, updated every second while visible'
+    COLUMNS = ["Name", "Calls", "Median ms", "90% ms", "Max ms", "MB read"]
+
+    def __init__(self):
+        super(InstrumentsDock, self).__init__("Instrumentation")
+        self.setFeatures(QtGui.QDockWidget.DockWidgetMovable | QtGui.QDockWidget.DockWidgetFloatable)
+        widget = QtGui.QWidget()
+        layout = QtGui.QVBoxLayout(widget)
+        self.table = QtGui.QTreeWidget()
+        self.table.setRootIsDecorated(False)
+        self.table.setHeaderLabels(self.COLUMNS)
+        layout.addWidget(self.table)
+        buttons = QtGui.QHBoxLayout()
+        reset_button = QtGui.QPushButton("Reset")
+        reset_button.clicked.connect(instruments.reset)
+        reset_button.clicked.connect(self.update_table)
+        save_button = QtGui.QPushButton("Save JSON...")
+        save_button.clicked.connect(self.save)
+        buttons.addWidget(reset_button)
+        buttons.addWidget(save_button)
+        layout.addLayout(buttons)
+        self.setWidget(widget)
+        self.update_timer = QtCore.QTimer()
+        self.update_timer.setInterval(1000)
+        self.update_timer.timeout.connect(self.update_table)
+
+    def showEvent(self, event):
+        self.update_table()
+        self.update_timer.start()
+        super(InstrumentsDock, self).showEvent(event)
+
+    def hideEvent(self, event):
+        self.update_timer.stop()
+        super(InstrumentsDock, self).hideEvent(event)
+
+    def update_table(self):
+        snapshot = instruments.snapshot()
+        mb = {k: v / 2. ** 20 for k, v in snapshot['bytes_read'].items()}
+        self.table.clear()
+        for name, h in sorted(snapshot['latency'].items()):
+            values = [name, h['n'], h['p50'] * 1000, h['p90'] * 1000, h['max'] * 1000]
+            self.table.addTopLevelItem(QtGui.QTreeWidgetItem(['%.2f' % v if isinstance(v, float) else str(v)
+                                                               for v in values] + ['%.1f' % mb.pop(name, 0)]))
+        for name, n in sorted(snapshot['counts'].items()):
+            self.table.addTopLevelItem(QtGui.QTreeWidgetItem([name, str(n)]))
+        for name, v in sorted(mb.items()):
+            self.table.addTopLevelItem(QtGui.QTreeWidgetItem([name, '', '', '', '', '%.1f' % v]))
+
+    def save(self):
+        fn = QtGui.QFileDialog.getSaveFileName(self, "Save Instrumentation", "instruments.json", "JSON (*.json)")
+        if fn:
+            instruments.dump(str(fn))
+
+
+# 1D datasets longer than this are plotted through a min/max decimation pyramid
+DECIMATION_THRESHOLD = 2 ** 20
+# 3D datasets larger than this many bytes are streamed frame by frame
+MOVIE_STREAMING_THRESHOLD = 2 ** 28
+# 2D datasets larger than this many bytes are shown through a tiled image pyramid
+IMAGE_TILING_THRESHOLD = 2 ** 28
+# Milliseconds between polls of the plotted datasets in follow mode
+FOLLOW_INTERVAL = 500
+# Bytes per second which computing statistics in the background may read
+STATISTICS_IO_BUDGET = 2 ** 28
+# Files a workspace keeps open at once
+MAX_OPEN_FILES = 64
+
+
+def open_metadata_cache():
+    try:
+        return MetadataCache()
+    except Exception:
+        logging.exception("Metadata cache not available")
+        return None
 
 
 class H5Plotter(QtGui.QMainWindow):
-    def __init__(self, file):
+    def __init__(self, file, follow=False, instrument=False, metadata_cache=None):
         super(H5Plotter, self).__init__()
-        view_box = SearchableH5View(H5File(file))
+        if metadata_cache is None:
+            metadata_cache = open_metadata_cache()
+        if isinstance(file, basestring):
+            model = H5Workspace(file, metadata_cache, swmr=follow)
+        else:
+            model = H5File(file, metadata_cache)
+        view_box = SearchableH5View(model)
         self.view = view_box.tree_view
         self.match_model = self.view.model()
         self.model = self.match_model.sourceModel()
-        self.dock_area = DockArea()
+        # Replaced by a DockArea when the first plot is made
+        self.dock_area = None
+        self.placeholder = QtGui.QLabel("Double click a dataset to plot it")
+        self.placeholder.setAlignment(Qt.AlignCenter)
 
         self.layout = QtGui.QSplitter(Qt.Horizontal)
         self.setCentralWidget(self.layout)
         self.view.activated.connect(self.load_plot)
         self.layout.addWidget(view_box)
-        self.layout.addWidget(self.dock_area)
+        self.layout.addWidget(self.placeholder)
         self.layout.setStretchFactor(0, 0)
         self.layout.setStretchFactor(1, 1)
 
         self.setWindowIcon(QtGui.QIcon("icon.ico"))
 
+        # dock -> [item, datasets to poll, extend function, loaded length]
+        self.followers = {}
+        self.follow_timer = QtCore.QTimer()
+        self.follow_timer.setInterval(FOLLOW_INTERVAL)
+        self.follow_timer.timeout.connect(self.follow_datasets)
+        if follow:
+            self.follow_timer.start()
+
         QtGui.QShortcut(QtGui.QKeySequence(Qt.CTRL | Qt.Key_N), self,
                         lambda: self.move_view_cursor(QtGui.QAbstractItemView.MoveDown))
         QtGui.QShortcut(QtGui.QKeySequence(Qt.CTRL | Qt.Key_P), self,
@@ -418,69 +1290,208 @@ class H5Plotter(QtGui.QMainWindow):
         toggle_junk_action.triggered.connect(self.match_model.toggle_junk_visible)
         view_menu.addAction(toggle_junk_action)
 
+        toggle_statistics_action = QtGui.QAction("Statistics Visible", view_menu)
+        toggle_statistics_action.setCheckable(True)
+        toggle_statistics_action.triggered.connect(self.set_statistics_visible)
+        view_menu.addAction(toggle_statistics_action)
+        self.set_statistics_visible(False)
+
+        refresh_action = QtGui.QAction("Refresh", view_menu)
+        refresh_action.setShortcut(QtGui.QKeySequence.Refresh)
+        refresh_action.triggered.connect(self.model.refresh)
+        view_menu.addAction(refresh_action)
+
+        self.instruments_dock = InstrumentsDock()
+        self.addDockWidget(Qt.BottomDockWidgetArea, self.instruments_dock)
+        self.instruments_dock.hide()
+        instruments_action = QtGui.QAction("Instrumentation", view_menu)
+        instruments_action.setCheckable(True)
+        instruments_action.triggered.connect(self.set_instrumented)
+        view_menu.addAction(instruments_action)
+        if instrument:
+            instruments_action.setChecked(True)
+            self.set_instrumented(True)
+
+        self.scan_label = QtGui.QLabel("Scanning...")
+        self.scan_progress_bar = QtGui.QProgressBar()
+        self.scan_progress_bar.setRange(0, 0)
+        self.scan_progress_bar.setMaximumWidth(150)
+        self.statusBar().addWidget(self.scan_label)
+        self.statusBar().addPermanentWidget(self.scan_progress_bar)
+        self.model.scan_progress.connect(self.show_scan_progress)
+        self.model.scan_finished.connect(self.show_scan_finished)
+        if not self.model.scanning:
+            self.show_scan_finished(self.model.scanned)
+
+    def set_statistics_visible(self, visible):
+        'statistics are only computed for the rows displayed while their columns are visible'
+        for c in range(2, len(COLUMN_NAMES)):
+            self.view.setColumnHidden(c, not visible)
+
+    def set_instrumented(self, enabled):
+        if enabled:
+            instruments.enable()
+        else:
+            instruments.disable()
+        self.instruments_dock.setVisible(enabled)
+
+    def show_scan_progress(self, count):
+        self.scan_label.setText("Scanning... %d nodes" % count)
+        self.scan_progress_bar.show()
+
+    def show_scan_finished(self, count):
+        self.scan_label.setText("%d nodes" % count)
+        self.scan_progress_bar.hide()
+
     def move_view_cursor(self, cursor_action):
         self.view.setFocus(Qt.OtherFocusReason)
         self.view.setCurrentIndex(self.view.moveCursor(cursor_action, Qt.NoModifier))
 
 
+    def get_dock_area(self):
+        if self.dock_area is None:
+            from pyqtgraph.dockarea import DockArea
+            self.dock_area = DockArea()
+            self.layout.insertWidget(1, self.dock_area)
+            self.layout.setStretchFactor(1, 1)
+            self.placeholder.hide()
+        return self.dock_area
+
+    @timed('H5Plotter.load_plot', split_reads=True)
     def load_plot(self, index):
         'given an index referring to an H5Dataset, puts a plot corresponding to that dataset in the plot area'
         source_index = self.match_model.mapToSource(index)
         item = self.model.itemFromIndex(source_index)
         if isinstance(item.row, H5DatasetRow) and item.row.plot is None:
-            labels = []
-            axes = []
-            for d in item.group.dims:
-                try:
-                    label, ds = d.items()[0]
-                    labels.append(label)
-                    axes.append(ds[:])
-                except IndexError:
-                    print 'Could not find axis in item', item
-                    labels.append('')
-                    axes.append(None)
-                except RuntimeError:
-                    print 'Mac bug? Probably no axis available'
-
-            dock = self.make_dock(item.name, item.group[:], labels, axes)
-            self.dock_area.addDock(dock)
+            labels, axes = dimension_scales(item.group)
+            dock_area = self.get_dock_area()
+            dock = self.make_dock(item.name, item.group, labels, axes)
+            dock_area.addDock(dock)
             item.plot = dock
+            self.model.plot_opened(item)
             dock.closeClicked.connect(lambda: item.__setattr__('plot', None))
-
-    def make_dock(self, name, array, labels=None, axes=None):
-        'returns a dockable plot widget'
-        labels = {pos: l for l, pos in zip(labels, ('bottom', 'left'))}
-        if len(array.shape) in (2, 3):
-            if len(array.shape) == 2:
-                d = CrossSectionDock(name=name, area=self.dock_area)
-            if len(array.shape) == 3:
-                d = MoviePlotDock(array, name=name, area=self.dock_area)
-            pos, scale = None, None
-            if axes is not None:
-                pos = [0, 0]
-                scale = [1, 1]
-                if axes[0] is not None:
-                    pos[0] = axes[0][0]
-                    scale[0] = axes[0][1] - axes[0][0]
-                if axes[1] is not None:
-                    pos[1] = axes[1][0]
-                    scale[1] = axes[1][1] - axes[1][0]
-            d.setImage(array, pos=pos, scale=scale)
-            if labels is not None:
-                d.setLabels(labels['bottom'], labels['left'], name)
-
-        if len(array.shape) == 1:
-            w = CrosshairPlotWidget(labels=labels)
+            dock.closeClicked.connect(lambda: self.model.plot_closed(item))
+
+            extend = self.follower(dock, item.group, axes)
+            if extend is not None:
+                datasets = [item.group]
+                if len(item.group.shape) == 1 and axes and axes[0] is not None:
+                    datasets.append(axes[0])
+                self.followers[dock] = [item, datasets, extend, item.group.shape[0]]
+                dock.closeClicked.connect(lambda: self.followers.pop(dock, None))
+
+    def follower(self, dock, dataset, axes):
+        """
+        returns a function extend(old_length, new_length) showing the entries appended to dataset along its first axis,
+        reading only those, or None if the plot in dock cannot follow its dataset
+        """
+        from plot_widgets import DecimatedPlotWidget, TiledCrossSectionDock, MoviePlotDock
+        if len(dataset.shape) == 1:
+            w = dock.widgets[0]
+            if isinstance(w, DecimatedPlotWidget):
+                return lambda n0, n1: w.extend(n1)
+            xdata = None
             if axes and axes[0] is not None:
-                w.plot(axes[0], array)
+                xdata = axes[0]
+            return lambda n0, n1: w.append_points(dataset[n0:n1], None if xdata is None else xdata[n0:n1])
+        if isinstance(dock, TiledCrossSectionDock):
+            return None
+        if isinstance(dock, MoviePlotDock):
+            if dock.streaming:
+                return lambda n0, n1: dock.extend(n1)
+            return lambda n0, n1: dock.append_frames(dataset[n0:n1])
+        return lambda n0, n1: dock.append_rows(dataset[n0:n1])
+
+    def follow_datasets(self):
+        'polls the extents of the plotted datasets, which another process may be writing to'
+        for follower in self.followers.values():
+            item, datasets, extend, n = follower
+            for ds in datasets:
+                ds.refresh()
+            new_n = min(ds.shape[0] for ds in datasets)
+            if new_n > n:
+                extend(n, new_n)
+                follower[3] = new_n
+                if item.row is not None:
+                    item.row.shape.setText(str(datasets[0].shape))
+
+    def make_dock(self, name, dataset, labels=None, axes=None):
+        return make_dock(name, dataset, labels, axes, area=self.dock_area)
+
+
+def dimension_scales(dataset):
+    'the label and dimension scale attached to each axis of dataset, an empty label and None where there is none'
+    labels = []
+    axes = []
+    for d in dataset.dims:
+        try:
+            label, ds = d.items()[0]
+            labels.append(label)
+            axes.append(ds)
+        except IndexError:
+            print 'Could not find axis in', dataset.name
+            labels.append('')
+            axes.append(None)
+        except RuntimeError:
+            print 'Mac bug? Probably no axis available'
+    return labels, axes
+
+
+def make_dock(name, dataset, labels=None, axes=None, area=None):
+    """
+    returns a dockable plot widget.
+    dataset and axes may be h5py datasets or arrays, they are only read as far as the plot needs
+    """
+    from plot_widgets import CrosshairPlotWidget, DecimatedPlotWidget, CloseableDock, CrossSectionDock, \
+        TiledCrossSectionDock, MoviePlotDock
+    from data_sources import MinMaxPyramid, FrameCache, ImagePyramid
+    labels = {pos: l for l, pos in zip(labels, ('bottom', 'left'))}
+    if len(dataset.shape) in (2, 3):
+        if len(dataset.shape) == 2:
+            if dataset.size * dataset.dtype.itemsize > IMAGE_TILING_THRESHOLD:
+                array = dataset
+                d = TiledCrossSectionDock(ImagePyramid(dataset), name=name, area=area)
+            else:
+                array = dataset[:]
+                d = CrossSectionDock(name=name, area=area)
+        if len(dataset.shape) == 3:
+            if dataset.size * dataset.dtype.itemsize > MOVIE_STREAMING_THRESHOLD:
+                array = FrameCache(dataset)
+            else:
+                array = dataset[:]
+            d = MoviePlotDock(array, name=name, area=area)
+        pos, scale = None, None
+        if axes is not None:
+            pos = [0, 0]
+            scale = [1, 1]
+            if axes[0] is not None:
+                pos[0] = axes[0][0]
+                scale[0] = axes[0][1] - axes[0][0]
+            if axes[1] is not None:
+                pos[1] = axes[1][0]
+                scale[1] = axes[1][1] - axes[1][0]
+        d.setImage(array, pos=pos, scale=scale)
+        if labels is not None:
+            d.setLabels(labels['bottom'], labels['left'], name)
+
+    if len(dataset.shape) == 1:
+        xdata = None
+        if axes and axes[0] is not None:
+            xdata = axes[0]
+        if len(dataset) > DECIMATION_THRESHOLD:
+            w = DecimatedPlotWidget(MinMaxPyramid(dataset, xdata), labels=labels)
+        else:
+            w = CrosshairPlotWidget(labels=labels)
+            if xdata is not None:
+                w.plot(xdata[:], dataset[:])
             else:
-                w.plot(array)
-            d = CloseableDock(name=name, widget=w, area=self.dock_area)
+                w.plot(dataset[:])
+        d = CloseableDock(name=name, widget=w, area=area)
 
-        return d
+    return d
 
 
-def main(fn):
+def main(fn, follow=False, instrument=False):
     if os.name == 'nt':
         try:
             import ctypes
@@ -490,19 +1501,46 @@ def main(fn):
             logging.warn("ctypes not found, appid not set")
 
 
-    with h5py.File(fn) as f:
+    metadata_cache = open_metadata_cache()
+    if is_workspace(fn):
+        # Many files, opened by the workspace as they are needed
+        show(fn, fn, follow, instrument, metadata_cache)
+    else:
+        # Opened through the metadata cache, as opening a file writable changes its mtime
+        open_file = h5py.File if metadata_cache is None else metadata_cache.open_file
+        with startup.phase("open file"):
+            if follow:
+                # Single writer / multiple reader mode, to read datasets while they are being written
+                f = open_file(fn, 'r', libver='latest', swmr=True)
+            else:
+                f = open_file(fn, 'a')
+        show(f, fn, follow, instrument, metadata_cache)
+    if instruments.has_data():
+        dump_fn = os.path.join(cache_dir(), 'instruments.json')
+        try:
+            instruments.dump(dump_fn)
+            print >> sys.stderr, "Instrumentation written to", dump_fn
+        except (IOError, OSError):
+            logging.exception("Could not write %s", dump_fn)
+    sys.exit()
+
+
+def show(file, title, follow=False, instrument=False, metadata_cache=None):
+    'runs the viewer on an open file or a workspace pattern until it is closed, then closes the files'
+    with startup.phase("create application"):
         app = QtGui.QApplication([])
-        win = H5Plotter(f)
-        win.setWindowTitle(fn)
+    with startup.phase("create main window"):
+        win = H5Plotter(file, follow=follow, instrument=instrument, metadata_cache=metadata_cache)
+        win.setWindowTitle(title)
+    with startup.phase("show main window"):
         win.show()
-        win.view.expandAll()
-        app.exec_()
-    sys.exit()
+    # Reported once the event loop runs, the window has been painted by then
+    QtCore.QTimer.singleShot(0, startup.report)
+    app.exec_()
+    win.model.close()
 
 
 def test():
-    import numpy as np
-
     test_fn = "test.h5"
     test_f = h5py.File(test_fn, 'w')
     A = test_f.create_group('group A1')
@@ -529,10 +1567,14 @@ def test():
 
 
 if __name__ == "__main__":
-    import sys
-
+    # In a frozen executable, the workspace scanner's pool processes start here too
+    import multiprocessing
+    multiprocessing.freeze_support()
+    follow = '--follow' in sys.argv
+    instrument = '--instrument' in sys.argv
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
     try:
-        main(sys.argv[1])
+        main(args[0], follow=follow, instrument=instrument)
     except IndexError:
         test()
 
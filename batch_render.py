@@ -0,0 +1,149 @@
+"""
+Renders datasets to image files without opening the viewer, e.g. for thumbnails or reports:
+
+    python batch_render.py run_*.h5 --match scan image --out thumbnails
+    python batch_render.py data.h5 --dataset /group/trace --dataset /group/movie --montage 9
+
+Datasets are plotted as in H5View: 1D as lines, 2D as images on their dimension scales, 3D as one frame
+or a montage of frames. The datasets are rendered by a pool of processes, each keeping its own handle
+on every file, so throughput grows with the number of cores.
+"""
+import math
+import multiprocessing
+import os
+import re
+import sys
+import time
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt4 import QtGui
+import h5py
+import numpy as np
+from metadata import scan
+
+# Per worker process: the QApplication, and the files opened so far by name
+app = None
+open_files = {}
+
+
+def find_datasets(filename, terms=()):
+    'the paths of the plottable datasets in a file whose paths contain all of terms'
+    with h5py.File(filename, 'r') as f:
+        return [node.path for batch in scan(f.id) for node in batch
+                if node.is_dataset and 1 <= len(node.shape) <= 3 and all(t in node.path for t in terms)]
+
+
+def output_name(filename, path, fmt):
+    base = os.path.splitext(os.path.basename(filename))[0] + path
+    return re.sub(r'[^\w.-]+', '_', base) + '.' + fmt
+
+
+def init_worker():
+    global app
+    app = QtGui.QApplication(['batch_render', '-platform', 'offscreen'])
+
+
+def get_file(filename):
+    f = open_files.get(filename)
+    if f is None:
+        f = open_files[filename] = h5py.File(filename, 'r')
+    return f
+
+
+def grab(area, size):
+    area.resize(*size)
+    area.show()
+    app.processEvents()
+    return QtGui.QPixmap.grabWidget(area)
+
+
+def render(dataset, size=(800, 600), frame=0, montage=None):
+    'a QImage of dataset plotted as H5View would, for 3D datasets either one frame or a grid of montage frames'
+    from pyqtgraph.dockarea import DockArea
+    from H5View import dimension_scales, make_dock
+    area = DockArea()
+    labels, axes = dimension_scales(dataset)
+    dock = make_dock(dataset.name.split('/')[-1], dataset, labels, axes, area=area)
+    area.addDock(dock)
+    try:
+        if len(dataset.shape) != 3:
+            return grab(area, size).toImage()
+        n = len(dataset)
+        frames = [min(frame, n - 1)] if montage is None else [int(i) for i in np.linspace(0, n - 1, min(montage, n))]
+        cols = int(math.ceil(math.sqrt(len(frames))))
+        rows = int(math.ceil(len(frames) / float(cols)))
+        tile_size = (size[0] // cols, size[1] // rows)
+        image = QtGui.QImage(tile_size[0] * cols, tile_size[1] * rows, QtGui.QImage.Format_RGB32)
+        image.fill(0xffffffff)
+        painter = QtGui.QPainter(image)
+        for k, i in enumerate(frames):
+            if dock.streaming:
+                dock.show_frame(i)
+            else:
+                dock.img_view.setCurrentIndex(i)
+            painter.drawPixmap((k % cols) * tile_size[0], (k // cols) * tile_size[1], grab(area, tile_size))
+        painter.end()
+        return image
+    finally:
+        dock.close()
+        area.close()
+
+
+def render_task(task):
+    'renders one dataset in a worker, returning (filename, path, output or None, error or None)'
+    filename, path, out_fn, options = task
+    try:
+        image = render(get_file(filename)[path], **options)
+        if not image.save(out_fn):
+            raise IOError("Could not write %s" % out_fn)
+        return filename, path, out_fn, None
+    except Exception as e:
+        return filename, path, None, '%s: %s' % (type(e).__name__, e)
+
+
+def main(filenames, paths=(), terms=(), out='.', fmt='png', size=(800, 600), frame=0, montage=None, workers=None):
+    if not os.path.isdir(out):
+        os.makedirs(out)
+    # Files are only listed in this process, and closed again before the workers are started
+    tasks = []
+    options = {'size': size, 'frame': frame, 'montage': montage}
+    for fn in filenames:
+        for path in (paths or find_datasets(fn, terms)):
+            tasks.append((fn, path, os.path.join(out, output_name(fn, path, fmt)), options))
+    if not tasks:
+        print >> sys.stderr, 'No datasets to render'
+        return 1
+
+    t0 = time.time()
+    failed = 0
+    pool = multiprocessing.Pool(workers, initializer=init_worker)
+    try:
+        for fn, path, out_fn, error in pool.imap_unordered(render_task, tasks):
+            if error is None:
+                print out_fn
+            else:
+                failed += 1
+                print >> sys.stderr, 'Could not render %s:%s, %s' % (fn, path, error)
+    finally:
+        pool.terminate()
+    print >> sys.stderr, 'Rendered %d of %d datasets in %.1fs' % (len(tasks) - failed, len(tasks), time.time() - t0)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Render HDF5 datasets to image files")
+    parser.add_argument('files', nargs='+', help="HDF5 files")
+    parser.add_argument('--dataset', action='append', default=[], help="path of a dataset to render, may be repeated")
+    parser.add_argument('--match', nargs='+', default=[],
+                        help="render every dataset whose path contains all of these terms, when no --dataset is given")
+    parser.add_argument('--out', default='.', help="directory for the images")
+    parser.add_argument('--format', default='png', help="image format, as known to Qt")
+    parser.add_argument('--size', default='800x600', help="image size as WIDTHxHEIGHT")
+    parser.add_argument('--frame', type=int, default=0, help="frame of 3D datasets to render")
+    parser.add_argument('--montage', type=int, help="render this many frames of 3D datasets in a grid instead")
+    parser.add_argument('--workers', type=int, help="number of processes, one per core by default")
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.lower().split('x'))
+    sys.exit(main(args.files, args.dataset, args.match, args.out, args.format, (width, height),
+                  args.frame, args.montage, args.workers))
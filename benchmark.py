@@ -0,0 +1,299 @@
+"""
+Headless benchmarks for H5View.
+
+Generates synthetic files, times the main operations of the viewer on them and writes the results as JSON,
+so that runs of different versions can be compared:
+
+    python benchmark.py [--scale 0.1] [--out results.json] [--keep]
+
+--scale multiplies the size of every generated dataset, and the thresholds above which datasets are
+decimated, tiled or streamed, so that small scales still exercise the same code paths.
+No display is needed where Qt has an offscreen platform, elsewhere run it under xvfb-run.
+"""
+import json
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt4 import QtGui, QtCore
+from PyQt4.Qt import Qt
+import h5py
+import numpy as np
+import H5View
+from plot_widgets import CROSSHAIR_LATENCY_TARGET
+
+# Variants in which every dataset file is written
+STORAGE_VARIANTS = {
+    'contiguous': {},
+    'chunked': {'chunks': True},
+    'gzip': {'chunks': True, 'compression': 'gzip', 'compression_opts': 1},
+}
+# The search term typed one key at a time
+SEARCH_TERM = 'node_3/node_1'
+
+
+def write_hierarchy(fn, depth, width, n_attrs=0, leaf_size=16):
+    'a tree of groups width wide and depth deep, with small datasets as leaves and n_attrs attributes on every node'
+    with h5py.File(fn, 'w') as f:
+        def fill(group, level):
+            for i in range(width):
+                name = 'node_%d' % i
+                if level + 1 < depth:
+                    child = group.create_group(name)
+                    fill(child, level + 1)
+                else:
+                    child = group.create_dataset(name, data=np.arange(leaf_size))
+                for a in range(n_attrs):
+                    child.attrs['attr_%d' % a] = a
+        fill(f, 0)
+    return fn
+
+
+def write_dataset(f, name, shape, storage, dtype='f4'):
+    'a dataset of smooth noise, written one slab along the first axis at a time'
+    ds = f.create_dataset(name, shape, dtype, **storage)
+    slab = max(2 ** 24 // (int(np.prod(shape[1:])) * np.dtype(dtype).itemsize), 1)
+    rng = np.random.RandomState(0)
+    for start in range(0, shape[0], slab):
+        n = min(slab, shape[0] - start)
+        ds[start:start + n] = np.sin(np.arange(start, start + n) / 100.).reshape((n,) + (1,) * (len(shape) - 1)) + \
+            rng.standard_normal((n,) + tuple(shape[1:])).astype(dtype) / 10
+    return ds
+
+
+def write_datasets(fn, storage):
+    'one dataset for each way H5View plots data, including ones beyond the decimation, tiling and streaming thresholds'
+    with h5py.File(fn, 'w') as f:
+        write_dataset(f, 'trace_short', (10 ** 4,), storage)
+        write_dataset(f, 'trace_long', (4 * H5View.DECIMATION_THRESHOLD,), storage)
+        write_dataset(f, 'image_small', (512, 512), storage)
+        side = int(math.sqrt(2 * H5View.IMAGE_TILING_THRESHOLD / 4))
+        write_dataset(f, 'image_large', (side, side), storage)
+        write_dataset(f, 'movie_small', (100, 100, 100), storage)
+        frames = 2 * H5View.MOVIE_STREAMING_THRESHOLD // (4 * 256 * 256)
+        write_dataset(f, 'movie_large', (frames, 256, 256), storage)
+    return fn
+
+
+def generate(directory, scale):
+    'writes the synthetic files into directory, returning {name: filename}'
+    files = {
+        'deep': write_hierarchy(os.path.join(directory, 'deep.h5'),
+                                depth=max(2, int(round(7 + math.log(scale, 4)))), width=4),
+        'wide': write_hierarchy(os.path.join(directory, 'wide.h5'), depth=1, width=max(int(20000 * scale), 10)),
+        'attrs': write_hierarchy(os.path.join(directory, 'attrs.h5'), depth=2, width=max(int(40 * math.sqrt(scale)), 2),
+                                 n_attrs=50),
+    }
+    for variant, storage in STORAGE_VARIANTS.items():
+        files['datasets_' + variant] = write_datasets(os.path.join(directory, variant + '.h5'), storage)
+    return files
+
+
+def summarize(times):
+    'statistics of a list of durations in seconds'
+    times = np.asarray(times, dtype=float)
+    return {'n': len(times), 'min': times.min(), 'median': float(np.median(times)), 'mean': times.mean(),
+            'max': times.max(), 'times': times.tolist()}
+
+
+def process_events(app):
+    app.processEvents()
+    app.processEvents()
+
+
+def wait_for(app, condition, timeout=600):
+    t0 = time.time()
+    while not condition():
+        if time.time() - t0 > timeout:
+            raise RuntimeError('Timed out')
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def populate_all(item):
+    item.populate()
+    for child in item.named_children.values():
+        if isinstance(child, H5View.H5ItemName):
+            populate_all(child)
+
+
+def load_item(model, path):
+    'the name item for path, populating its ancestors'
+    names = path.strip('/').split('/')
+    item = model.named_children[names[0]]
+    for name in names[1:]:
+        item.populate()
+        item = item.named_children[name]
+    return item
+
+
+def bench_model_build(app, fn, metadata_cache=None):
+    'seconds until the first rows exist, and until the scan is finished. With a cache, fn is opened as the viewer does'
+    f = h5py.File(fn, 'r') if metadata_cache is None else metadata_cache.open_file(fn, 'a')
+    t0 = time.time()
+    model = H5View.H5File(f, metadata_cache)
+    first_rows = time.time() - t0
+    wait_for(app, lambda: not model.scanning)
+    return model, first_rows, time.time() - t0
+
+
+def bench_tree(app, files, directory, results):
+    for name in ('deep', 'wide', 'attrs'):
+        model, first_rows, scan = bench_model_build(app, files[name])
+        results['model_build/%s/first_rows' % name] = summarize([first_rows])
+        results['model_build/%s/scan' % name] = summarize([scan])
+        t0 = time.time()
+        for item in model.named_children.values():
+            if isinstance(item, H5View.H5ItemName):
+                populate_all(item)
+        results['model_build/%s/populate_all' % name] = summarize([time.time() - t0])
+
+        # Reopening through the metadata cache, once stored and the file closed again
+        cache = H5View.MetadataCache(os.path.join(directory, 'metadata_%s.sqlite' % name))
+        cached_model, _, _ = bench_model_build(app, files[name], cache)
+        wait_for(app, lambda: cache.load_index(files[name]) is not None)
+        cached_model.close()
+        cached_model, first_rows, scan = bench_model_build(app, files[name], cache)
+        if cached_model.scanner is not None:
+            print >> sys.stderr, 'Metadata cache missed for', name
+        results['model_build/%s/cached' % name] = summarize([scan])
+        cached_model.close()
+
+        match_model = H5View.RecursiveFilterModel()
+        match_model.setSourceModel(model)
+        match_model.set_match_term('')
+        keystrokes = []
+        for i in range(1, len(SEARCH_TERM) + 1):
+            t0 = time.time()
+            match_model.set_match_term(SEARCH_TERM[:i])
+            keystrokes.append(time.time() - t0)
+        results['search_keystroke/%s' % name] = summarize(keystrokes)
+        match_model.set_match_term('')
+
+        sorts = []
+        for order in (Qt.DescendingOrder, Qt.AscendingOrder):
+            t0 = time.time()
+            match_model.sort(0, order)
+            sorts.append(time.time() - t0)
+        results['sort/%s' % name] = summarize(sorts)
+        model.file.close()
+
+
+def bench_plots(app, files, results, crosshair_moves=100, movie_seconds=2):
+    rng = np.random.RandomState(0)
+    for variant in STORAGE_VARIANTS:
+        f = h5py.File(files['datasets_' + variant], 'r')
+        win = H5View.H5Plotter(f)
+        win.resize(1200, 800)
+        win.show()
+        wait_for(app, lambda: not win.model.scanning)
+        for name in sorted(f.keys()):
+            item = load_item(win.model, '/' + name)
+            index = win.match_model.mapFromSource(item.index())
+            t0 = time.time()
+            win.load_plot(index)
+            process_events(app)
+            results['load_plot/%s/%s' % (variant, name)] = summarize([time.time() - t0])
+            dock = item.plot
+
+            if name.startswith('image'):
+                dock.add_cross_section()
+                process_events(app)
+                nx, ny = dock.image_shape()
+                updates = []
+                dock.cross_section_latency.clear()
+                for _ in range(crosshair_moves):
+                    target = dock.x_cross_index, dock.y_cross_index = rng.randint(nx), rng.randint(ny)
+                    t0 = time.time()
+                    # As on a mouse move. Tiled images draw the traces once they have been read in the background
+                    dock.schedule_cross_section()
+                    wait_for(app, lambda: dock.drawn_cross_index == target)
+                    process_events(app)
+                    updates.append(time.time() - t0)
+                results['crosshair_update/%s/%s' % (variant, name)] = summarize(updates)
+                # From the move to the traces being painted, as measured by the dock against its target
+                if dock.cross_section_latency:
+                    latency = summarize(dock.cross_section_latency)
+                    latency['target'] = CROSSHAIR_LATENCY_TARGET
+                    latency['exceeded'] = bool(dock.latency_exceeded())
+                    results['crosshair_latency/%s/%s' % (variant, name)] = latency
+
+            if name.startswith('movie'):
+                # Plays for a while, timing the intervals between the frames shown
+                player = dock.player
+                player.start()
+                t0 = time.time()
+                while time.time() - t0 < movie_seconds:
+                    app.processEvents()
+                    time.sleep(0.001)
+                player.stop()
+                if len(player.shown_at) > 1:
+                    playback = summarize(np.diff(player.shown_at))
+                    playback['target'] = player.stride / float(player.rate)
+                    playback['skipped'] = player.skipped
+                    results['movie_playback/%s/%s' % (variant, name)] = playback
+
+            dock.close()
+            item.plot = None
+            process_events(app)
+        win.close()
+        f.close()
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'h5py': h5py.version.version, 'hdf5': h5py.version.hdf5_version, 'numpy': np.__version__,
+            'qt': QtCore.QT_VERSION_STR, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def main(scale=0.1, out=None, keep=False):
+    app = QtGui.QApplication(['benchmark', '-platform', 'offscreen'])
+    directory = tempfile.mkdtemp(prefix='h5view-benchmark-')
+    # Keeps H5Plotter's metadata cache out of the user's cache directory
+    os.environ['XDG_CACHE_HOME'] = os.environ['LOCALAPPDATA'] = directory
+    H5View.DECIMATION_THRESHOLD = int(H5View.DECIMATION_THRESHOLD * scale)
+    H5View.IMAGE_TILING_THRESHOLD = int(H5View.IMAGE_TILING_THRESHOLD * scale)
+    H5View.MOVIE_STREAMING_THRESHOLD = int(H5View.MOVIE_STREAMING_THRESHOLD * scale)
+    try:
+        t0 = time.time()
+        files = generate(directory, scale)
+        print >> sys.stderr, 'Generated files in %.1fs' % (time.time() - t0)
+        results = {}
+        bench_tree(app, files, directory, results)
+        bench_plots(app, files, results)
+    finally:
+        if keep:
+            print >> sys.stderr, 'Files kept in', directory
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    report = {'environment': environment(), 'scale': scale, 'results': results}
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if out is None:
+        print text
+    else:
+        with open(out, 'w') as f:
+            f.write(text)
+    for name in sorted(results):
+        print >> sys.stderr, '%10.2f ms  %s' % (results[name]['median'] * 1000, name)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Headless H5View benchmarks")
+    parser.add_argument('--scale', type=float, default=0.1, help="size of the generated data, 1 for full size")
+    parser.add_argument('--out', help="file to write the JSON results to, instead of stdout")
+    parser.add_argument('--keep', action='store_true', help="keep the generated files")
+    args = parser.parse_args()
+    main(args.scale, args.out, args.keep)
@@ -0,0 +1,366 @@
+from collections import OrderedDict
+import itertools
+import threading
+import numpy as np
+
+
+def block_size(dataset, target, multiple_of=1):
+    'a read size along the first axis near target, aligned to the dataset chunking and to multiple_of'
+    step = multiple_of
+    chunks = getattr(dataset, 'chunks', None)
+    if chunks:
+        step = step * chunks[0] // gcd(step, chunks[0])
+    return max(target // step, 1) * step
+
+
+def gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def block_shape(shape, chunks, itemsize, max_bytes, multiple_of=1):
+    """
+    the shape of blocks tiling an array of shape along its chunk grid, each of at most max_bytes: whole chunks along
+    every axis, as many as fit starting from the last axis. A chunk which alone is over max_bytes is split along
+    its leading axes instead. Sides are multiples of multiple_of, which may take a block over max_bytes
+    """
+    unit = [c * multiple_of // gcd(c, multiple_of) for c in (chunks or (1,) * len(shape))]
+    nbytes = lambda b: int(np.prod(b)) * itemsize
+    for axis in range(len(unit)):
+        while nbytes(unit) > max_bytes and unit[axis] > multiple_of:
+            unit[axis] = max(unit[axis] // 2 // multiple_of * multiple_of, multiple_of)
+    block = list(unit)
+    for axis in reversed(range(len(block))):
+        block[axis] = min(block[axis] * max(max_bytes // nbytes(block), 1), max(shape[axis], 1))
+        if block[axis] < shape[axis]:
+            break
+    return tuple(block)
+
+
+def blocks(shape, block):
+    'the tuples of slices selecting each block of the given shape tiling an array of shape'
+    return itertools.product(*[[slice(i, min(i + b, n)) for i in range(0, n, b)] for n, b in zip(shape, block)])
+
+
+class MinMaxPyramid(object):
+    """
+    Min/max envelopes of a long 1D dataset, built in a single streaming pass over it.
+    Level 0 summarizes bins of base_factor samples, every further level halves the resolution.
+    Windows small enough to draw directly are read from the dataset at full resolution.
+    """
+    def __init__(self, dataset, xdata=None, base_factor=256, min_bins=1024, block_bins=4096):
+        self.dataset = dataset
+        self.xdata = xdata
+        self.size = len(dataset)
+        self.base_factor = base_factor
+        self.min_bins = min_bins
+        self.block_bins = block_bins
+        self.build_levels(self.summarize(0, self.size))
+
+    def summarize(self, start, stop):
+        'level 0 bins for the samples from start, a multiple of base_factor, to stop'
+        base_factor = self.base_factor
+        n_bins = -(-(stop - start) // base_factor)
+        mins = np.empty(n_bins, dtype=self.dataset.dtype)
+        maxs = np.empty(n_bins, dtype=self.dataset.dtype)
+        if self.xdata is None:
+            xs = np.arange(start // base_factor, start // base_factor + n_bins, dtype=float) * base_factor
+        else:
+            xs = np.empty(n_bins, dtype=self.xdata.dtype)
+        block = block_size(self.dataset, base_factor * self.block_bins, base_factor)
+        for block_start in range(start, stop, block):
+            data = np.asarray(self.dataset[block_start:min(block_start+block, stop)])
+            bins = np.arange(0, len(data), base_factor)
+            b0 = (block_start - start) // base_factor
+            mins[b0:b0+len(bins)] = np.minimum.reduceat(data, bins)
+            maxs[b0:b0+len(bins)] = np.maximum.reduceat(data, bins)
+            if self.xdata is not None:
+                xs[b0:b0+len(bins)] = np.asarray(self.xdata[block_start:block_start+len(data)])[::base_factor]
+        return xs, mins, maxs
+
+    def build_levels(self, level0):
+        xs, mins, maxs = level0
+        self.levels = [level0]
+        while len(xs) > 2 * self.min_bins:
+            pairs = np.arange(0, len(xs), 2)
+            xs, mins, maxs = xs[pairs], np.minimum.reduceat(mins, pairs), np.maximum.reduceat(maxs, pairs)
+            self.levels.append((xs, mins, maxs))
+
+    def extend(self, n):
+        'takes in the samples appended to the dataset since it was summarized, up to n, reading only those'
+        if n <= self.size:
+            return
+        b0 = self.size // self.base_factor
+        tail = self.summarize(b0 * self.base_factor, n)
+        self.size = n
+        self.build_levels([np.concatenate((old[:b0], new)) for old, new in zip(self.levels[0], tail)])
+
+    def x_range(self):
+        xs = self.levels[0][0]
+        if self.xdata is None:
+            return 0, self.size - 1
+        return xs[0], self.xdata[self.size - 1]
+
+    def get(self, x_min, x_max, max_points):
+        """
+        returns x, y arrays for the window [x_min, x_max], at the finest resolution giving at most max_points points.
+        The first and last samples of the dataset are always included so that autoranging still sees the full extent.
+        """
+        xs = self.levels[0][0]
+        i0 = max(np.searchsorted(xs, x_min) - 1, 0)
+        i1 = min(np.searchsorted(xs, x_max) + 1, len(xs))
+        start, stop = i0 * self.base_factor, min(i1 * self.base_factor, self.size)
+        if stop - start <= max_points:
+            y = np.asarray(self.dataset[start:stop])
+            if self.xdata is None:
+                x = np.arange(start, stop, dtype=float)
+            else:
+                x = np.asarray(self.xdata[start:stop])
+        else:
+            for xs, mins, maxs in self.levels:
+                i0 = max(np.searchsorted(xs, x_min) - 1, 0)
+                i1 = min(np.searchsorted(xs, x_max) + 1, len(xs))
+                if 2 * (i1 - i0) <= max_points:
+                    break
+            x = np.repeat(xs[i0:i1], 2)
+            y = np.column_stack((mins[i0:i1], maxs[i0:i1])).ravel()
+        first, last = self.x_range()
+        if x[0] > first:
+            x = np.concatenate(([first], x))
+            y = np.concatenate(([self.dataset[0]], y))
+        if x[-1] < last:
+            x = np.concatenate((x, [last]))
+            y = np.concatenate((y, [self.dataset[self.size - 1]]))
+        return x, y
+
+
+class FrameCache(object):
+    """
+    Reads the frames of a 3D dataset one hyperslab at a time, keeping the most recently used ones in memory.
+    prefetch() queues frames to be read ahead on a background thread, so memory use depends on
+    the cache size rather than the dataset size.
+    """
+    def __init__(self, dataset, size=32):
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.size = size
+        self.frames = OrderedDict()
+        self.wanted = []
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def grow(self, n):
+        'follows frames appended to the dataset, up to n'
+        self.shape = (n,) + self.shape[1:]
+
+    def __getitem__(self, i):
+        with self.condition:
+            frame = self.frames.pop(i, None)
+            if frame is not None:
+                self.frames[i] = frame
+                return frame
+        return self.load(i)
+
+    def load(self, i):
+        frame = np.asarray(self.dataset[i])
+        with self.condition:
+            self.frames[i] = frame
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+        return frame
+
+    def prefetch(self, indices):
+        'replaces the read-ahead queue, frames already cached are skipped'
+        with self.condition:
+            self.wanted = [i for i in indices if i not in self.frames][:self.size]
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.wanted and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                i = self.wanted.pop(0)
+                if i in self.frames:
+                    continue
+            self.load(i)
+
+
+class GrowingArray(object):
+    """
+    An array appended to along its first axis, as data arrives while following a file. Room is reserved by
+    doubling, so a run of appends copies each row a bounded number of times instead of once per append.
+    """
+    def __init__(self, array):
+        self.buffer = np.asarray(array)
+        self.size = len(self.buffer)
+
+    def append(self, rows):
+        'adds rows at the end, returning a view of everything so far'
+        rows = np.asarray(rows)
+        n = self.size + len(rows)
+        dtype = np.result_type(self.buffer, rows)
+        if n > len(self.buffer) or dtype != self.buffer.dtype:
+            buffer = np.empty((max(n, 2 * len(self.buffer)),) + self.buffer.shape[1:], dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+        self.buffer[self.size:n] = rows
+        self.size = n
+        return self.view()
+
+    def view(self):
+        return self.buffer[:self.size]
+
+    def holds(self, array):
+        'whether array is still the contents of this buffer, rather than data set since'
+        return array is not None and len(array) == self.size and np.may_share_memory(array, self.buffer)
+
+
+def block_means(data, f):
+    'the means of the f x f blocks of a 2D array, those at its ends over the part of them inside it'
+    nx, ny = data.shape
+    w, h = -(-nx // f), -(-ny // f)
+    if (nx, ny) == (w * f, h * f):
+        return data.reshape(w, f, h, f).mean(axis=(1, 3))
+    padded = np.zeros((w * f, h * f))
+    padded[:nx, :ny] = data
+    counts = np.outer(np.minimum(nx - np.arange(w) * f, f), np.minimum(ny - np.arange(h) * f, f))
+    return padded.reshape(w, f, h, f).sum(axis=(1, 3)) / counts
+
+
+class ImagePyramid(object):
+    """
+    Downsampled copies of a large 2D dataset, for drawing it at any zoom without reading it whole.
+    Levels downsampled by base_factor or more are block means built in memory by one streaming pass
+    over the dataset, finer levels are read from the dataset with a stride, one tile at a time.
+    The pass is made by build(), which may run on another thread; until it is done there are no levels.
+    """
+    def __init__(self, dataset, max_base_pixels=2**22, min_level_pixels=2**16, block_bytes=2**26):
+        self.dataset = dataset
+        self.shape = nx, ny = dataset.shape
+        self.min_level_pixels = min_level_pixels
+        self.block_bytes = block_bytes
+        f = 1
+        while -(-nx // f) * -(-ny // f) > max_base_pixels:
+            f *= 2
+        self.base_factor = f
+        self.levels = {}
+
+    def build(self, cancelled=lambda: False):
+        'reads the dataset once to build the levels, returning whether it was done before cancelled() became true'
+        f = self.base_factor
+        nx, ny = self.shape
+        base = np.empty((-(-nx // f), -(-ny // f)))
+        # Blocks are read as floats, which bounds the memory they take
+        itemsize = max(self.dataset.dtype.itemsize, base.itemsize)
+        for sx, sy in blocks(self.shape, block_shape(self.shape, self.dataset.chunks, itemsize, self.block_bytes, f)):
+            if cancelled():
+                return False
+            means = block_means(np.asarray(self.dataset[sx, sy], dtype=float), f)
+            base[sx.start // f:sx.start // f + means.shape[0], sy.start // f:sy.start // f + means.shape[1]] = means
+
+        levels = {f: base}
+        level = base
+        while level.size > self.min_level_pixels and min(level.shape) >= 2:
+            level = block_means(level, 2)
+            f *= 2
+            levels[f] = level
+        self.levels = levels
+        return True
+
+    def overview(self):
+        'the coarsest level which is still detailed, that downsampled by base_factor, or None until built'
+        return self.levels.get(self.base_factor)
+
+    def read_tile(self, factor, tx, ty, tile_size):
+        'the tile at (tx, ty) of the level downsampled by factor, with tile_size pixels on a side'
+        x0, y0 = tx * tile_size, ty * tile_size
+        if factor in self.levels:
+            return self.levels[factor][x0:x0 + tile_size, y0:y0 + tile_size]
+        x0, y0, span = x0 * factor, y0 * factor, tile_size * factor
+        return np.asarray(self.dataset[x0:x0 + span:factor, y0:y0 + span:factor])
+
+
+# Levels estimated from a sample clip this fraction of values at either end, in percent
+LEVEL_PERCENTILES = (0.1, 99.9)
+
+
+class Reservoir(object):
+    'a uniform random sample of fixed size from the finite values of a stream, fed in blocks'
+    def __init__(self, size=2**16, seed=0):
+        self.size = size
+        self.values = np.empty(size)
+        self.seen = 0
+        self.random = np.random.RandomState(seed)
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[np.isfinite(values)]
+        fill = max(min(self.size - self.seen, len(values)), 0)
+        self.values[self.seen:self.seen + fill] = values[:fill]
+        rest = values[fill:]
+        start = self.seen + fill
+        self.seen += len(values)
+        if len(rest):
+            # Algorithm R: the i-th value replaces a random slot with probability size / i
+            slots = (self.random.random_sample(len(rest)) * np.arange(start + 1, start + len(rest) + 1)).astype(np.int64)
+            keep = slots < self.size
+            self.values[slots[keep]] = rest[keep]
+
+    def sample(self):
+        return self.values[:min(self.seen, self.size)]
+
+
+def sample_levels(data, sample_size=2**16, percentiles=LEVEL_PERCENTILES):
+    """
+    display levels for an in-memory array, without scanning it: its min and max if it is no larger than sample_size,
+    else percentiles of a random sample of that size
+    """
+    data = np.asarray(data)
+    if data.size <= sample_size:
+        sample = np.asarray(data, dtype=float).ravel()
+        sample = sample[np.isfinite(sample)]
+        return (sample.min(), sample.max()) if sample.size else (0., 1.)
+    index = np.unravel_index(np.random.RandomState(0).randint(0, data.size, sample_size), data.shape)
+    sample = np.asarray(data[index], dtype=float)
+    sample = sample[np.isfinite(sample)]
+    if not sample.size:
+        return 0., 1.
+    lo, hi = np.percentile(sample, percentiles)
+    return lo, hi
+
+
+def estimate_levels(source, max_blocks=64, max_bytes=2**27, sample_size=2**16, percentiles=LEVEL_PERCENTILES,
+                    cancelled=lambda: False):
+    """
+    display levels for an array, dataset or FrameCache too large to read, from a reservoir sample of evenly
+    spaced slices along its first axis, reading at most max_bytes. Returns None if cancelled() becomes true first
+    """
+    n = len(source)
+    block_bytes = int(np.prod(source.shape[1:])) * source.dtype.itemsize
+    n_blocks = max(min(max_blocks, n, max_bytes // max(block_bytes, 1)), 1)
+    reservoir = Reservoir(sample_size)
+    for i in np.unique(np.linspace(0, n - 1, n_blocks).astype(int)):
+        if cancelled():
+            return None
+        reservoir.add(source[int(i)])
+    sample = reservoir.sample()
+    if not len(sample):
+        return None
+    lo, hi = np.percentile(sample, percentiles)
+    return lo, hi
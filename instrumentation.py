@@ -0,0 +1,160 @@
+from functools import wraps
+import json
+import math
+import threading
+import time
+import h5py
+
+
+class Histogram(object):
+    'latencies in buckets a quarter octave wide, starting at a microsecond'
+    BUCKETS_PER_OCTAVE = 4
+    N_BUCKETS = 4 * 32
+
+    def __init__(self):
+        self.counts = [0] * self.N_BUCKETS
+        self.n = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        bucket = int(self.BUCKETS_PER_OCTAVE * math.log(us, 2)) if us > 1 else 0
+        self.counts[min(bucket, self.N_BUCKETS - 1)] += 1
+        self.n += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @classmethod
+    def bucket_bound(cls, i):
+        'the upper bound in seconds of bucket i'
+        return 2 ** (float(i + 1) / cls.BUCKETS_PER_OCTAVE) * 1e-6
+
+    def percentile(self, q):
+        'an upper bound on the q-th percentile, to within a bucket'
+        if not self.n:
+            return 0.
+        rank = q / 100. * self.n
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= rank:
+                return min(self.bucket_bound(i), self.max)
+        return self.max
+
+    def to_dict(self):
+        last = max([i for i, c in enumerate(self.counts) if c] or [0])
+        return {'n': self.n, 'total': self.total, 'mean': self.total / self.n if self.n else 0., 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'bucket_bounds': [self.bucket_bound(i) for i in range(last + 1)], 'counts': self.counts[:last + 1]}
+
+
+class Instruments(object):
+    """
+    Latency histograms, call counts and bytes read for the hot paths, collected only while enabled.
+    Functions decorated with timed() are timed under their name, while enabled h5py dataset reads are timed too,
+    and their bytes and time are attributed to the timed calls in progress on the same thread.
+    When disabled, a timed function costs one attribute check, and h5py is left untouched.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.original_getitem = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.bytes_read = {}
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.original_getitem = h5py.Dataset.__getitem__
+        instruments = self
+        original = self.original_getitem
+
+        def getitem(dataset, selection):
+            t0 = time.time()
+            result = original(dataset, selection)
+            instruments.record_read(time.time() - t0, getattr(result, 'nbytes', 0))
+            return result
+        h5py.Dataset.__getitem__ = getitem
+        self.enabled = True
+
+    def disable(self):
+        if not self.enabled:
+            return
+        h5py.Dataset.__getitem__ = self.original_getitem
+        self.enabled = False
+
+    def has_data(self):
+        return bool(self.histograms or self.counters)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def record_read(self, seconds, nbytes):
+        self.record('h5py read', seconds)
+        frames = getattr(self.local, 'frames', None)
+        with self.lock:
+            if not frames:
+                self.bytes_read['unattributed'] = self.bytes_read.get('unattributed', 0) + nbytes
+                return
+            self.bytes_read[frames[-1][0]] = self.bytes_read.get(frames[-1][0], 0) + nbytes
+            for frame in frames:
+                frame[1] += seconds
+
+    def timed(self, name, split_reads=False):
+        """
+        decorates a function to be timed under name while enabled.
+        With split_reads, the time spent reading datasets and the rest are also recorded, as name/read and name/render
+        """
+        def decorate(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                return self.call(name, split_reads, f, args, kwargs)
+            return wrapper
+        return decorate
+
+    def call(self, name, split_reads, f, args, kwargs):
+        frames = getattr(self.local, 'frames', None)
+        if frames is None:
+            frames = self.local.frames = []
+        frame = [name, 0.]
+        frames.append(frame)
+        t0 = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            elapsed = time.time() - t0
+            frames.pop()
+            self.record(name, elapsed)
+            if split_reads:
+                self.record(name + '/read', frame[1])
+                self.record(name + '/render', elapsed - frame[1])
+
+    def snapshot(self):
+        with self.lock:
+            return {'latency': {k: h.to_dict() for k, h in self.histograms.items()},
+                    'counts': dict(self.counters), 'bytes_read': dict(self.bytes_read)}
+
+    def dump(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+
+
+instruments = Instruments()
+timed = instruments.timed
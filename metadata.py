@@ -0,0 +1,364 @@
+from collections import deque, namedtuple
+from contextlib import contextmanager
+import cPickle as pickle
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import numpy as np
+from PyQt4 import QtCore
+import h5py
+from h5py import h5a, h5d, h5g, h5o
+
+
+# Set by h5py for dimension scales, not shown or indexed
+AXIS_ATTRS = ('DIMENSION_SCALE', 'DIMENSION_LIST', 'CLASS', 'NAME', 'REFERENCE_LIST')
+
+
+class NodeInfo(namedtuple('NodeInfo', 'path is_dataset shape dtype attrs')):
+    'what a scan records about one group or dataset, without building any tree items'
+
+
+def scan(fid, batch_size=1000, stopped=lambda: False):
+    """
+    yields lists of NodeInfo for every link below the root of an open file id, breadth first.
+    Only short low-level calls are made, so other threads are never locked out of h5py for long.
+    Objects reachable through several hard or soft links are recorded under each path, but the members of a group
+    are only scanned below the first path found to it, which also keeps cycles finite.
+    Committed datatypes and other objects which are neither groups nor datasets are recorded as leaves.
+    """
+    root = h5o.get_info(fid)
+    # Addresses are only unique within a file, external links may lead to others
+    seen = {(root.fileno, root.addr)}
+    groups = deque([''])
+    batch = []
+    while groups:
+        group_path = groups.popleft()
+        names = []
+        gid = h5o.open(fid, group_path or '/')
+        gid.links.iterate(names.append)
+        for name in names:
+            if stopped():
+                return
+            path = group_path + '/' + name
+            try:
+                oid = h5o.open(fid, path)
+            except KeyError:
+                # Dangling soft or external link
+                continue
+            attrs = []
+            h5a.iterate(oid, attrs.append)
+            if isinstance(oid, h5d.DatasetID):
+                batch.append(NodeInfo(path, True, oid.shape, oid.dtype, attrs))
+            else:
+                batch.append(NodeInfo(path, False, None, None, attrs))
+                if isinstance(oid, h5g.GroupID):
+                    info = h5o.get_info(oid)
+                    if (info.fileno, info.addr) not in seen:
+                        seen.add((info.fileno, info.addr))
+                        groups.append(path)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class MetadataScanner(QtCore.QObject):
+    """
+    Scans a file on a background thread, delivering NodeInfo batches through batch_scanned
+    and the number of objects found through scan_finished.
+    """
+    batch_scanned = QtCore.pyqtSignal(object)
+    scan_finished = QtCore.pyqtSignal(int)
+
+    def __init__(self, file, batch_size=2000):
+        super(MetadataScanner, self).__init__()
+        self.file = file
+        self.batch_size = batch_size
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        count = 0
+        try:
+            for batch in scan(self.file.id, self.batch_size, lambda: self.stopped):
+                count += len(batch)
+                self.batch_scanned.emit(batch)
+        except Exception:
+            logging.exception("Scanning %s failed", self.file.filename)
+        if not self.stopped:
+            self.scan_finished.emit(count)
+
+
+def scan_file(args):
+    """
+    the NodeInfo records of a whole file, from the cache at db_path when it is up to date, else by scanning it
+    and storing the result. file_key is the current_key() of the file in the viewer, which may have opened it.
+    Runs in a worker process, returning (label, nodes, error message or None)
+    """
+    label, filename, db_path, file_key = args
+    cache = nodes = None
+    if db_path:
+        # The cache only saves work, the file is scanned whenever it cannot be used
+        try:
+            cache = MetadataCache(db_path)
+            nodes = cache.load_nodes(filename, file_key=file_key)
+        except Exception:
+            logging.exception("Could not read the metadata cache for %s", filename)
+    try:
+        if nodes is None:
+            file_key = file_key or MetadataCache.file_key(filename)
+            with h5py.File(filename, 'r') as f:
+                nodes = [n for batch in scan(f.id) for n in batch]
+            if cache:
+                store_nodes(cache, file_key, nodes)
+        return label, nodes, None
+    except Exception as e:
+        return label, [], '%s: %s' % (type(e).__name__, e)
+
+
+def store_nodes(cache, file_key, nodes):
+    'stores the scan of a file from a worker, only logging failures such as the database being locked by another'
+    try:
+        # Imported here, search_index is not needed by the other workers
+        from search_index import PathIndex
+        index = PathIndex()
+        for n in nodes:
+            index.add(n.path)
+            for k in n.attrs:
+                if k not in AXIS_ATTRS:
+                    index.add(n.path + '/' + k)
+        cache.store(file_key, nodes, index)
+    except Exception:
+        logging.exception("Could not write the metadata cache for %s", file_key[0])
+
+
+class WorkspaceScanner(QtCore.QObject):
+    """
+    Scans many files at once on a pool of processes, delivering the NodeInfo records of each file
+    through file_scanned as (label, nodes), and the number of objects found in all of them through scan_finished.
+    """
+    file_scanned = QtCore.pyqtSignal(object, object)
+    scan_finished = QtCore.pyqtSignal(int)
+
+    def __init__(self, files, db_path=None, workers=None):
+        'files are (label, filename, file_key) tuples, file_key as for scan_file'
+        super(WorkspaceScanner, self).__init__()
+        self.files = files
+        self.db_path = db_path
+        self.workers = workers
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+
+    def run(self):
+        count = 0
+        pool = multiprocessing.Pool(self.workers)
+        try:
+            tasks = [(label, filename, self.db_path, file_key) for label, filename, file_key in self.files]
+            for label, nodes, error in pool.imap_unordered(scan_file, tasks):
+                if self.stopped:
+                    return
+                if error is not None:
+                    logging.error("Scanning %s failed: %s", label, error)
+                count += len(nodes)
+                self.file_scanned.emit(label, nodes)
+        except Exception:
+            logging.exception("Scanning the workspace failed")
+        finally:
+            pool.terminate()
+        if not self.stopped:
+            self.scan_finished.emit(count)
+
+
+def cache_dir():
+    'the per-user cache directory for H5View'
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'h5view')
+
+
+class MetadataCache(object):
+    """
+    Scan results kept in an SQLite database, so that reopening an unchanged file does not scan it again.
+    Entries are keyed by the absolute path of the file, and only used while its size and mtime still match.
+    Besides the NodeInfo records, the pickled PathIndex is stored so that search works straight away.
+    A new connection is made for every call, so the cache can be used from any thread.
+
+    Opening a file writable changes its mtime, and so does closing it. Files opened with open_file() are
+    matched by their key from before they were opened for as long as nothing else changes them, and once
+    closed with close_file() their entry is moved to the key they are left with, unless the viewer wrote to
+    them in between, see file_modified().
+    """
+    SCHEMA_VERSION = 2
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            if not os.path.isdir(cache_dir()):
+                os.makedirs(cache_dir())
+            db_path = os.path.join(cache_dir(), 'metadata.sqlite')
+        self.db_path = db_path
+        # Absolute filename: [key before it was opened, key once open, number of handles open]
+        self.own_keys = {}
+        self.modified = set()
+        with self.connect() as db:
+            # Entries in an older layout are dropped, they are only a cache
+            if db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                db.execute('DROP TABLE IF EXISTS files')
+                db.execute('DROP TABLE IF EXISTS nodes')
+                db.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+            db.execute('CREATE TABLE IF NOT EXISTS files '
+                       '(id INTEGER PRIMARY KEY, filename TEXT UNIQUE, size INTEGER, mtime REAL, path_index BLOB)')
+            db.execute('CREATE TABLE IF NOT EXISTS nodes (file_id INTEGER, depth INTEGER, path TEXT, '
+                       'is_dataset INTEGER, shape TEXT, dtype TEXT, attrs TEXT)')
+            db.execute('CREATE INDEX IF NOT EXISTS nodes_by_file ON nodes (file_id, depth)')
+
+    @contextmanager
+    def connect(self):
+        'a connection for one transaction, committed or rolled back and then closed at the end of the with block'
+        # Workspace scans write from many processes at once, which wait their turn
+        db = sqlite3.connect(self.db_path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    @staticmethod
+    def file_key(filename):
+        stat = os.stat(filename)
+        return os.path.abspath(filename), stat.st_size, stat.st_mtime
+
+    def current_key(self, filename):
+        'the key to match the entry for filename against, ignoring the changes to its mtime made by open_file()'
+        key = self.file_key(filename)
+        own = self.own_keys.get(key[0])
+        if own is not None and key == own[1]:
+            return own[0]
+        return key
+
+    def open_file(self, filename, mode='r', **kwargs):
+        'opens filename with h5py, noting its key from before it was opened'
+        name = os.path.abspath(filename)
+        before = self.file_key(filename)
+        f = h5py.File(filename, mode, **kwargs)
+        own = self.own_keys.get(name)
+        if own is None:
+            if name not in self.modified:
+                self.own_keys[name] = [before, self.file_key(filename), 1]
+        elif before == own[1]:
+            own[2] += 1
+        else:
+            # Changed by another program while open, the key from before no longer describes it
+            del self.own_keys[name]
+        return f
+
+    def close_file(self, f):
+        'closes a file opened by open_file(), moving its entry to the key it is left with once no handle is open'
+        name = os.path.abspath(f.filename)
+        own = self.own_keys.get(name)
+        if own is not None and self.file_key(name) != own[1]:
+            del self.own_keys[name]
+            own = None
+        f.close()
+        if own is None:
+            return
+        own[2] -= 1
+        if not own[2]:
+            del self.own_keys[name]
+            try:
+                self.restamp(own[0], self.file_key(name))
+            except Exception:
+                logging.exception("Could not update the metadata cache for %s", name)
+
+    def file_modified(self, filename):
+        'called when the viewer writes to filename, whose entry is then no longer used'
+        name = os.path.abspath(filename)
+        self.modified.add(name)
+        self.own_keys.pop(name, None)
+
+    def restamp(self, old_key, new_key):
+        'moves the entry stored under old_key to new_key'
+        name, size, mtime = new_key
+        with self.connect() as db:
+            db.execute('UPDATE files SET size = ?, mtime = ? WHERE filename = ? AND size = ? AND mtime = ?',
+                       (size, mtime) + tuple(old_key))
+
+    def lookup(self, db, filename, file_key=None):
+        'the id of the entry for filename, if there is one matching the file as it is now or file_key'
+        name, size, mtime = file_key or self.current_key(filename)
+        row = db.execute('SELECT id FROM files WHERE filename = ? AND size = ? AND mtime = ?',
+                         (name, size, mtime)).fetchone()
+        return row[0] if row else None
+
+    def load_index(self, filename):
+        'the PathIndex stored for filename, or None if the file has changed or was never stored'
+        with self.connect() as db:
+            file_id = self.lookup(db, filename)
+            if file_id is None:
+                return None
+            blob, = db.execute('SELECT path_index FROM files WHERE id = ?', (file_id,)).fetchone()
+        return pickle.loads(str(blob))
+
+    def load_nodes(self, filename, depth=None, file_key=None):
+        'the NodeInfo records stored for filename, optionally only those at one depth below the root'
+        with self.connect() as db:
+            file_id = self.lookup(db, filename, file_key)
+            if file_id is None:
+                return None
+            query = 'SELECT path, is_dataset, shape, dtype, attrs FROM nodes WHERE file_id = ?'
+            args = (file_id,)
+            if depth is not None:
+                query += ' AND depth = ?'
+                args += (depth,)
+            rows = db.execute(query, args).fetchall()
+        return [NodeInfo(str(path), bool(is_dataset),
+                         tuple(json.loads(shape)) if is_dataset else None,
+                         np.dtype(str(dtype)) if is_dataset else None,
+                         [str(a) for a in json.loads(attrs)])
+                for path, is_dataset, shape, dtype, attrs in rows]
+
+    def load_shapes(self, filename):
+        'the (path, shape) of every 1D dataset stored for filename, or None if the file has changed or was never stored'
+        with self.connect() as db:
+            file_id = self.lookup(db, filename)
+            if file_id is None:
+                return None
+            # Shapes are stored as JSON lists, those of 1D datasets have no comma
+            rows = db.execute("SELECT path, shape FROM nodes WHERE file_id = ? AND is_dataset AND shape NOT LIKE '%,%'",
+                              (file_id,)).fetchall()
+        return [(str(path), tuple(json.loads(shape))) for path, shape in rows]
+
+    def store(self, file_key, nodes, path_index):
+        'replaces the entry for a file, file_key being its current_key() from before the scan'
+        name, size, mtime = file_key
+        with path_index.lock:
+            blob = pickle.dumps(path_index, 2)
+        rows = ((n.path.count('/'), n.path, n.is_dataset, json.dumps(n.shape), n.dtype.str if n.is_dataset else None,
+                 json.dumps(n.attrs)) for n in nodes)
+        with self.connect() as db:
+            row = db.execute('SELECT id FROM files WHERE filename = ?', (name,)).fetchone()
+            if row is not None:
+                db.execute('DELETE FROM nodes WHERE file_id = ?', row)
+                db.execute('DELETE FROM files WHERE id = ?', row)
+            file_id = db.execute('INSERT INTO files (filename, size, mtime, path_index) VALUES (?, ?, ?, ?)',
+                                 (name, size, mtime, sqlite3.Binary(blob))).lastrowid
+            db.executemany('INSERT INTO nodes VALUES (%d, ?, ?, ?, ?, ?, ?)' % file_id, rows)
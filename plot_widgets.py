@@ -1,9 +1,18 @@
 from PyQt4 import QtGui, QtCore
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 import warnings
 import pyqtgraph as pg
 import numpy as np
 from pyqtgraph.dockarea import Dock
+from instrumentation import instruments, timed
+from data_sources import GrowingArray, sample_levels, estimate_levels
 
+DISPLAY_RATE = 60.
+# Seconds from a mouse move to the redrawn cross section traces: two display frames
+CROSSHAIR_LATENCY_TARGET = 2 / DISPLAY_RATE
 
 class CloseableDock(Dock):
     def __init__(self, *args, **kwargs):
@@ -23,6 +32,8 @@ class CloseableDock(Dock):
             self._container.apoptose()
 
 class CrosshairPlotWidget(pg.PlotWidget):
+    painted = QtCore.pyqtSignal()
+
     def __init__(self, parametric=False, *args, **kwargs):
         super(CrosshairPlotWidget, self).__init__(*args, **kwargs)
         self.scene().sigMouseClicked.connect(self.toggle_search)
@@ -32,12 +43,30 @@ class CrosshairPlotWidget(pg.PlotWidget):
         self.search_mode = True
         self.label = None
         self.selected_point = None
+        self.point_index = None
+        self.point_index_curves = None
+        self.grown_curve = None
+
+    def paintEvent(self, event):
+        super(CrosshairPlotWidget, self).paintEvent(event)
+        self.painted.emit()
 
     def set_data(self, data):
         if data is not None and len(data) > 0:
             self.clear()
             self.plot(data)
 
+    def append_points(self, y, x=None):
+        'extends the first curve with new points, x defaults to continuing the sample index'
+        curve = [i for i in self.getPlotItem().items if isinstance(i, pg.PlotDataItem)][0]
+        if x is None:
+            x = np.arange(len(curve.xData), len(curve.xData) + len(y))
+        # The buffers are kept while the curve still shows what was last appended to them
+        grown = self.grown_curve
+        if grown is None or grown[0] is not curve or not grown[2].holds(curve.yData):
+            grown = self.grown_curve = curve, GrowingArray(curve.xData), GrowingArray(curve.yData)
+        curve.setData(grown[1].append(x), grown[2].append(y))
+
     def toggle_search(self, mouse_event):
         if mouse_event.double():
             if self.cross_section_enabled:
@@ -56,19 +85,18 @@ class CrosshairPlotWidget(pg.PlotWidget):
             view_coords = vb.mapSceneToView(mouse_event)
             view_x, view_y = view_coords.x(), view_coords.y()
 
-            best_guesses = []
-            for data_item in item.items:
-                if isinstance(data_item, pg.PlotDataItem):
-                    xdata, ydata = data_item.xData, data_item.yData
-                    index_distance = lambda i: (xdata[i]-view_x)**2 + (ydata[i] - view_y)**2
-                    if self.parametric:
-                        index = min(range(len(xdata)), key=index_distance)
-                    else:
+            if self.parametric:
+                best_guesses = self.nearest_parametric_point(view_x, view_y)
+            else:
+                best_guesses = []
+                for data_item in item.items:
+                    if isinstance(data_item, pg.PlotDataItem):
+                        xdata, ydata = data_item.xData, data_item.yData
                         index = min(np.searchsorted(xdata, view_x), len(xdata)-1)
                         if index and xdata[index] - view_x > view_x - xdata[index - 1]:
                             index -= 1
-                    pt_x, pt_y = xdata[index], ydata[index]
-                    best_guesses.append(((pt_x, pt_y), index_distance(index)))
+                        pt_x, pt_y = xdata[index], ydata[index]
+                        best_guesses.append(((pt_x, pt_y), (pt_x - view_x)**2 + (pt_y - view_y)**2))
 
             if not best_guesses:
                 return
@@ -79,6 +107,26 @@ class CrosshairPlotWidget(pg.PlotWidget):
             self.h_line.setPos(pt_y)
             self.label.setText("x=%.2e, y=%.2e" % (pt_x, pt_y))
 
+    def nearest_parametric_point(self, view_x, view_y):
+        """
+        returns [((x, y), distance**2)] for the closest point of any curve, or [] if there are no points.
+        All curves share one KD-tree, rebuilt only when the data of some curve has been replaced
+        """
+        curves = [(i.xData, i.yData) for i in self.getPlotItem().items
+                  if isinstance(i, pg.PlotDataItem) and i.xData is not None]
+        if self.point_index_curves is None or len(curves) != len(self.point_index_curves) or \
+                any(x is not x0 or y is not y0 for (x, y), (x0, y0) in zip(curves, self.point_index_curves)):
+            self.point_index_curves = curves
+            points = np.concatenate([np.column_stack((x, y)) for x, y in curves]) if curves else np.zeros((0, 2))
+            self.point_index_points = points[np.isfinite(points).all(axis=1)]
+            # scipy is only imported once a parametric plot is first hovered, it adds a lot to startup
+            from scipy.spatial import cKDTree
+            self.point_index = cKDTree(self.point_index_points) if len(self.point_index_points) else None
+        if self.point_index is None:
+            return []
+        distance, index = self.point_index.query((view_x, view_y))
+        return [(tuple(self.point_index_points[index]), distance**2)]
+
     def add_cross_hair(self):
         self.h_line = pg.InfiniteLine(angle=0, movable=False)
         self.v_line = pg.InfiniteLine(angle=90, movable=False)
@@ -96,7 +144,35 @@ class CrosshairPlotWidget(pg.PlotWidget):
         self.removeItem(self.v_line)
         self.cross_section_enabled = False
 
+class DecimatedPlotWidget(CrosshairPlotWidget):
+    """
+    Plots a MinMaxPyramid, fetching the resolution which fits the visible x range each time it changes,
+    so that only a few thousand points are ever drawn
+    """
+    def __init__(self, pyramid, max_points=4000, *args, **kwargs):
+        super(DecimatedPlotWidget, self).__init__(*args, **kwargs)
+        self.pyramid = pyramid
+        self.max_points = max_points
+        x_min, x_max = pyramid.x_range()
+        self.curve = self.plot(*pyramid.get(x_min, x_max, max_points))
+        self.getPlotItem().getViewBox().sigXRangeChanged.connect(self.update_resolution)
+
+    def update_resolution(self, view_box, x_range):
+        x_min, x_max = x_range
+        self.curve.setData(*self.pyramid.get(x_min, x_max, self.max_points))
+
+    def extend(self, n):
+        'follows the dataset as it grows to n samples'
+        self.pyramid.extend(n)
+        self.update_resolution(None, self.getPlotItem().getViewBox().viewRange()[0])
+
 class CrossSectionDock(CloseableDock):
+    """
+    Auto levels are estimated from a sample of the image rather than a scan of it. Where the image shown is not
+    all of the data, the levels are refined in the background from a sample of the data, see level_source().
+    """
+    levels_estimated = QtCore.pyqtSignal(object, object)
+
     def __init__(self, trace_size=80, **kwargs):
         self.plot_item = view = pg.PlotItem(labels=kwargs.pop('labels', None))
         self.img_view = kwargs['widget'] = pg.ImageView(view=view)
@@ -108,6 +184,22 @@ class CrossSectionDock(CloseableDock):
         self.cross_section_enabled = False
         self.search_mode = False
         self.signals_connected = False
+        self.axis_key = None
+        self.drawn_cross_index = None
+        self.z_val = 0
+        # Traces are redrawn at most once per display frame, however fast the mouse moves
+        self.cross_section_timer = QtCore.QTimer()
+        self.cross_section_timer.setSingleShot(True)
+        self.cross_section_timer.setInterval(int(1000 / DISPLAY_RATE))
+        self.cross_section_timer.timeout.connect(self.update_cross_section)
+        # When the crosshair moved, for the traces being drawn and for those drawn but not yet painted
+        self.pending_since = None
+        self.paint_pending_since = None
+        self.cross_section_latency = deque(maxlen=100)
+        self.level_generation = 0
+        self.provisional_levels = None
+        self.grown_image = None
+        self.levels_estimated.connect(self.apply_estimated_levels)
         self.set_histogram(False)
         histogram_action = QtGui.QAction('Histogram', self)
         histogram_action.setCheckable(True)
@@ -122,6 +214,7 @@ class CrossSectionDock(CloseableDock):
 
         self.y_cross_index = 0
         self.h_cross_section_widget = CrosshairPlotWidget()
+        self.h_cross_section_widget.painted.connect(self.traces_painted)
         self.h_cross_dock = CloseableDock(name='x trace', widget=self.h_cross_section_widget, area=self.area)
         self.h_cross_section_widget.add_cross_hair()
         self.h_cross_section_widget.search_mode = False
@@ -154,9 +247,51 @@ class CrossSectionDock(CloseableDock):
         else:
             self._xscale, self._yscale = 1, 1
 
-        self.img_view.setImage(*args, **kwargs)
+        self.img_view.setImage(*args, **self.estimate_levels(args[0], kwargs))
         self.update_cross_section()
 
+    def estimate_levels(self, image, kwargs):
+        'replaces automatic levels in setImage kwargs by levels from a sample of image, refined later if possible'
+        if not kwargs.get('autoLevels', True) or kwargs.get('levels') is not None:
+            return kwargs
+        levels = self.provisional_levels = sample_levels(image)
+        self.level_generation += 1
+        source = self.level_source()
+        if source is not None:
+            generation = self.level_generation
+            cancelled = lambda: generation != self.level_generation
+
+            def refine():
+                try:
+                    self.levels_estimated.emit(generation, estimate_levels(source, cancelled=cancelled))
+                except Exception as e:
+                    warnings.warn('Could not estimate levels: %s' % e)
+            thread = threading.Thread(target=refine)
+            thread.daemon = True
+            thread.start()
+        return dict(kwargs, levels=levels, autoLevels=False)
+
+    def level_source(self):
+        'the data to refine the levels from, if the image shown is only part of it'
+        return None
+
+    def apply_estimated_levels(self, generation, levels):
+        if generation != self.level_generation or levels is None:
+            return
+        # Levels which have been changed since they were set are left alone
+        if not np.allclose(self.imageItem.levels, self.provisional_levels):
+            return
+        self.img_view.setLevels(*levels)
+
+    def append_rows(self, rows):
+        'extends the image along its first axis, keeping the view and levels'
+        # The buffer is kept while the image shown is still what was last appended to it
+        if self.grown_image is None or not self.grown_image.holds(self.img_view.image):
+            self.grown_image = GrowingArray(self.img_view.image)
+        image = self.grown_image.append(rows)
+        self.setImage(image, pos=(self._x0, self._y0), scale=(self._xscale, self._yscale),
+                      autoRange=False, autoLevels=False)
+
     def toggle_cross_section(self):
         if self.cross_section_enabled:
             self.hide_cross_section()
@@ -180,6 +315,7 @@ class CrossSectionDock(CloseableDock):
         self.plot_item.addItem(self.v_line, ignoreBounds=False)
         self.x_cross_index = 0
         self.y_cross_index = 0
+        self.drawn_cross_index = None
         self.cross_section_enabled = True
         self.text_item = pg.LabelItem(justify="right")
         #self.img_view.ui.gridLayout.addWidget(self.text_item, 2, 1, 1, 2)
@@ -211,7 +347,7 @@ class CrossSectionDock(CloseableDock):
             raise RuntimeError('Signal can only be connected after it has been embedded in a scene.')
         self.imageItem.scene().sigMouseClicked.connect(self.toggle_search)
         self.imageItem.scene().sigMouseMoved.connect(self.handle_mouse_move)
-        self.img_view.timeLine.sigPositionChanged.connect(self.update_cross_section)
+        self.img_view.timeLine.sigPositionChanged.connect(lambda *args: self.update_cross_section())
         self.signals_connected = True
 
     def toggle_search(self, mouse_event):
@@ -226,54 +362,584 @@ class CrossSectionDock(CloseableDock):
         if self.cross_section_enabled and self.search_mode:
             view_coords = self.imageItem.getViewBox().mapSceneToView(mouse_event)
             view_x, view_y = view_coords.x(), view_coords.y()
-            item_coords = self.imageItem.mapFromScene(mouse_event)
-            item_x, item_y = item_coords.x(), item_coords.y()
-            max_x, max_y = self.imageItem.image.shape
+            item_x, item_y = self.image_coords(mouse_event)
+            max_x, max_y = self.image_shape()
             if item_x < 0 or item_x > max_x or item_y < 0 or item_y > max_y:
                 return
             self.v_line.setPos(view_x)
             self.h_line.setPos(view_y)
             #(min_view_x, max_view_x), (min_view_y, max_view_y) = self.imageItem.getViewBox().viewRange()
-            self.x_cross_index = max(min(int(item_x), max_x-1), 0)
-            self.y_cross_index = max(min(int(item_y), max_y-1), 0)
-            z_val = self.imageItem.image[self.x_cross_index, self.y_cross_index]
-            self.update_cross_section()
-            self.text_item.setText("x=%.2e, y=%.2e, z=%.2e" % (view_x, view_y, z_val))
-
+            x_index = max(min(int(item_x), max_x-1), 0)
+            y_index = max(min(int(item_y), max_y-1), 0)
+            if (x_index, y_index) != (self.x_cross_index, self.y_cross_index):
+                self.x_cross_index, self.y_cross_index = x_index, y_index
+                self.z_val = self.image_value(x_index, y_index)
+            self.schedule_cross_section()
+            self.text_item.setText("x=%.2e, y=%.2e, z=%.2e" % (view_x, view_y, self.z_val))
+
+    def schedule_cross_section(self):
+        'redraws the traces on the next display frame, if the crosshair has moved to another pixel'
+        if (self.x_cross_index, self.y_cross_index) == self.drawn_cross_index:
+            return
+        if not self.cross_section_timer.isActive():
+            self.pending_since = time.time()
+            self.cross_section_timer.start()
+
+    def axis_data(self):
+        'the x and y coordinates of every pixel, recomputed only when the image shape, position or scale change'
+        nx, ny = shape = self.image_shape()
+        key = (shape, self._x0, self._y0, self._xscale, self._yscale)
+        if key != self.axis_key:
+            x0, y0, xscale, yscale = self._x0, self._y0, self._xscale, self._yscale
+            self.xdata = np.linspace(x0, x0+(xscale*(nx-1)), nx)
+            self.ydata = np.linspace(y0, y0+(yscale*(ny-1)), ny)
+            self.axis_key = key
+        return self.xdata, self.ydata
+
+    @timed('CrossSectionDock.update_cross_section')
     def update_cross_section(self):
-        nx, ny = self.imageItem.image.shape
-        x0, y0, xscale, yscale = self._x0, self._y0, self._xscale, self._yscale
-        xdata = np.linspace(x0, x0+(xscale*(nx-1)), nx)
-        ydata = np.linspace(y0, y0+(yscale*(ny-1)), ny)
-        zval = self.imageItem.image[self.x_cross_index, self.y_cross_index]
-        self.h_cross_section_widget_data.setData(xdata, self.imageItem.image[:, self.y_cross_index])
-        self.h_cross_section_widget.v_line.setPos(xdata[self.x_cross_index])
+        self.cross_section_timer.stop()
+        x, y = self.x_cross_index, self.y_cross_index
+        self.draw_cross_section((x, y), self.image_value(x, y), self.x_trace(y), self.y_trace(x))
+
+    def draw_cross_section(self, index, zval, x_trace, y_trace):
+        'draws the traces through the pixel at index, whose value is zval'
+        xdata, ydata = self.axis_data()
+        x, y = index
+        self.z_val = zval
+        self.h_cross_section_widget_data.setData(xdata, x_trace)
+        self.h_cross_section_widget.v_line.setPos(xdata[x])
         self.h_cross_section_widget.h_line.setPos(zval)
-        self.v_cross_section_widget_data.setData(ydata, self.imageItem.image[self.x_cross_index, :])
-        self.v_cross_section_widget.v_line.setPos(ydata[self.y_cross_index])
+        self.v_cross_section_widget_data.setData(ydata, y_trace)
+        self.v_cross_section_widget.v_line.setPos(ydata[y])
         self.v_cross_section_widget.h_line.setPos(zval)
+        self.drawn_cross_index = index
+        if self.pending_since is not None:
+            self.paint_pending_since = self.pending_since
+            self.pending_since = None
+
+    def traces_painted(self):
+        'records the time from a crosshair move to the traces being painted, also in the instruments when enabled'
+        if self.paint_pending_since is None:
+            return
+        latency = time.time() - self.paint_pending_since
+        self.paint_pending_since = None
+        self.cross_section_latency.append(latency)
+        if instruments.enabled:
+            instruments.record('CrossSectionDock.crosshair_latency', latency)
+            if latency > CROSSHAIR_LATENCY_TARGET:
+                instruments.count('CrossSectionDock.crosshair_latency_exceeded')
+
+    def latency_exceeded(self):
+        'whether the median delay from mouse move to trace redraw is over CROSSHAIR_LATENCY_TARGET'
+        if not self.cross_section_latency:
+            return False
+        return np.median(self.cross_section_latency) > CROSSHAIR_LATENCY_TARGET
+
+    # Access to the full resolution image, overridden when the displayed image is not the data itself
+
+    def image_coords(self, scene_pos):
+        item_coords = self.imageItem.mapFromScene(scene_pos)
+        return item_coords.x(), item_coords.y()
+
+    def image_shape(self):
+        return self.imageItem.image.shape
+
+    def image_value(self, x, y):
+        return self.imageItem.image[x, y]
+
+    def x_trace(self, y):
+        return self.imageItem.image[:, y]
+
+    def y_trace(self, x):
+        return self.imageItem.image[x, :]
+
+
+class TiledCrossSectionDock(CrossSectionDock):
+    """
+    Shows a 2D dataset too large to load. An overview from an ImagePyramid is overlaid with tiles of the
+    visible region at the resolution of the current zoom, read on a pool of worker threads.
+    The pyramid is built on the same pool, a blank image covering the dataset is shown until it is done.
+    Crosshair traces are read from the dataset at full resolution on the same pool, one pixel at a time:
+    while a read is in flight only the newest crosshair position is kept to be read next.
+    """
+    tile_loaded = QtCore.pyqtSignal(object, object)
+    traces_loaded = QtCore.pyqtSignal(object, object)
+    pyramid_built = QtCore.pyqtSignal()
+
+    def __init__(self, pyramid, tile_size=256, workers=4, cache_tiles=256, max_tiles=64, **kwargs):
+        super(TiledCrossSectionDock, self).__init__(**kwargs)
+        self.pyramid = pyramid
+        self.tile_size = tile_size
+        self.cache_tiles = cache_tiles
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.pending = set()
+        self.detail_request = None
+        self.pool = ThreadPool(workers)
+        self.tile_loaded.connect(self.store_tile)
+        self.trace_request = None
+        self.trace_reading = False
+        self.traces_loaded.connect(self.store_traces)
+        self.closed = False
+        self.image_pos = self.image_kwargs = None
+        self.pyramid_built.connect(self.show_overview)
+        if self.pyramid.overview() is None:
+            self.pool.apply_async(self.build_pyramid, callback=lambda built: built and self.pyramid_built.emit())
+
+        self.detail_item = pg.ImageItem()
+        self.detail_item.hide()
+        self.plot_item.addItem(self.detail_item)
+        self.detail_timer = QtCore.QTimer()
+        self.detail_timer.setSingleShot(True)
+        self.detail_timer.setInterval(50)
+        self.detail_timer.timeout.connect(self.update_detail)
+        self.plot_item.getViewBox().sigRangeChanged.connect(lambda *args: self.detail_timer.start())
+        self.ui.histogram.item.sigLevelsChanged.connect(self.update_detail_levels)
+        self.ui.histogram.item.sigLookupTableChanged.connect(self.update_detail_levels)
+
+    def build_pyramid(self):
+        try:
+            return self.pyramid.build(lambda: self.closed)
+        except Exception as e:
+            warnings.warn('Could not build the overview of %s: %s' % (self.pyramid.dataset.name, e))
+
+    def setImage(self, dataset=None, pos=None, scale=None, **kwargs):
+        'the dataset is taken from the pyramid, the overview is shown scaled up to full resolution coordinates'
+        pos = pos or (0, 0)
+        scale = scale or (1, 1)
+        self._x0, self._y0 = pos
+        self._xscale, self._yscale = scale
+        self.image_kwargs = kwargs
+        self.show_overview(autoRange=kwargs.get('autoRange', True))
+        self.tiles.clear()
+        self.detail_timer.start()
+        if self.cross_section_enabled:
+            self.update_cross_section()
+
+    def show_overview(self, autoRange=False):
+        'the overview once built, keeping the view the user has zoomed to meanwhile, until then a blank image'
+        if self.image_kwargs is None:
+            return
+        pos, scale = (self._x0, self._y0), (self._xscale, self._yscale)
+        kwargs = dict(self.image_kwargs, autoRange=autoRange)
+        overview = self.pyramid.overview()
+        if overview is None:
+            nx, ny = self.pyramid.shape
+            kwargs.update(autoLevels=False, levels=(0, 1))
+            self.img_view.setImage(np.zeros((1, 1)), pos=pos, scale=(scale[0] * nx, scale[1] * ny), **kwargs)
+            return
+        f = self.pyramid.base_factor
+        kwargs = self.estimate_levels(overview, kwargs)
+        self.img_view.setImage(overview, pos=pos, scale=(scale[0] * f, scale[1] * f), **kwargs)
+        self.detail_timer.start()
+
+    def level_source(self):
+        return self.pyramid.dataset
+
+    def image_coords(self, scene_pos):
+        view_coords = self.imageItem.getViewBox().mapSceneToView(scene_pos)
+        return (view_coords.x() - self._x0) / self._xscale, (view_coords.y() - self._y0) / self._yscale
+
+    def image_shape(self):
+        return self.pyramid.shape
+
+    def image_value(self, x, y):
+        'the value of the overview at a pixel, until the traces through it have been read'
+        f = self.pyramid.base_factor
+        overview = self.pyramid.overview()
+        if overview is None:
+            return np.nan
+        return overview[min(x // f, overview.shape[0] - 1), min(y // f, overview.shape[1] - 1)]
+
+    # Read in the pool, they decompress a whole row or column of chunks
+
+    def x_trace(self, y):
+        return self.pyramid.dataset[:, y]
+
+    def y_trace(self, x):
+        return self.pyramid.dataset[x, :]
+
+    def update_cross_section(self):
+        'requests the traces through the crosshair, drawn once they have been read'
+        self.cross_section_timer.stop()
+        self.trace_request = (self.x_cross_index, self.y_cross_index)
+        if not self.trace_reading:
+            self.read_traces(self.trace_request)
+
+    def read_traces(self, key):
+        self.trace_reading = True
+        self.pool.apply_async(self.load_traces, key, callback=lambda traces: self.traces_loaded.emit(key, traces))
+
+    def load_traces(self, x, y):
+        try:
+            x_trace = np.asarray(self.x_trace(y))
+            return x_trace[x], x_trace, np.asarray(self.y_trace(x))
+        except Exception as e:
+            warnings.warn('Could not read the traces through %s: %s' % ((x, y), e))
+
+    def store_traces(self, key, traces):
+        self.trace_reading = False
+        if key != self.trace_request:
+            self.read_traces(self.trace_request)
+        if traces is not None:
+            self.draw_cross_section(key, *traces)
+            if self.cross_section_enabled:
+                xdata, ydata = self.axis_data()
+                self.text_item.setText("x=%.2e, y=%.2e, z=%.2e" % (xdata[key[0]], ydata[key[1]], traces[0]))
+
+    def update_detail(self):
+        'requests the tiles covering the visible region, at the coarsest level still as sharp as the screen'
+        vb = self.plot_item.getViewBox()
+        (vx0, vx1), (vy0, vy1) = vb.viewRange()
+        nx, ny = self.pyramid.shape
+        x0 = int(max((vx0 - self._x0) / self._xscale, 0))
+        x1 = int(min((vx1 - self._x0) / self._xscale + 1, nx))
+        y0 = int(max((vy0 - self._y0) / self._yscale, 0))
+        y1 = int(min((vy1 - self._y0) / self._yscale + 1, ny))
+        if x1 <= x0 or y1 <= y0:
+            return
+        screen_pixels = max(vb.width(), vb.height(), 1)
+        factor = 1
+        while factor < self.pyramid.base_factor and max(x1 - x0, y1 - y0) / (2 * factor) >= screen_pixels:
+            factor *= 2
+        if factor >= self.pyramid.base_factor:
+            self.detail_request = None
+            self.detail_item.hide()
+            return
+
+        span = self.tile_size * factor
+        txs = range(x0 // span, (x1 - 1) // span + 1)
+        tys = range(y0 // span, (y1 - 1) // span + 1)
+        if len(txs) * len(tys) > self.max_tiles:
+            return
+        self.detail_request = (factor, txs, tys)
+        for tx in txs:
+            for ty in tys:
+                key = (factor, tx, ty)
+                if key not in self.tiles and key not in self.pending:
+                    self.pending.add(key)
+                    self.pool.apply_async(self.read_tile, key,
+                                          callback=lambda tile, key=key: self.tile_loaded.emit(key, tile))
+        self.show_detail()
+
+    def read_tile(self, factor, tx, ty):
+        try:
+            return self.pyramid.read_tile(factor, tx, ty, self.tile_size)
+        except Exception as e:
+            warnings.warn('Could not read tile %s: %s' % ((factor, tx, ty), e))
+
+    def store_tile(self, key, tile):
+        self.pending.discard(key)
+        if tile is None:
+            return
+        self.tiles[key] = tile
+        while len(self.tiles) > self.cache_tiles:
+            self.tiles.popitem(last=False)
+        self.show_detail()
+
+    def show_detail(self):
+        'once every tile of the current request is available, shows them stitched together'
+        if self.detail_request is None:
+            return
+        factor, txs, tys = self.detail_request
+        keys = [[(factor, tx, ty) for ty in tys] for tx in txs]
+        if not all(k in self.tiles for row in keys for k in row):
+            return
+        img = np.concatenate([np.concatenate([self.tiles[k] for k in row], axis=1) for row in keys], axis=0)
+        x0 = txs[0] * self.tile_size * factor
+        y0 = tys[0] * self.tile_size * factor
+        rect = QtCore.QRectF(self._x0 + x0 * self._xscale, self._y0 + y0 * self._yscale,
+                             img.shape[0] * factor * self._xscale, img.shape[1] * factor * self._yscale)
+        self.detail_item.setImage(img, autoLevels=False, levels=self.imageItem.levels, lut=self.imageItem.lut)
+        self.detail_item.setRect(rect)
+        self.detail_item.show()
+
+    def update_detail_levels(self):
+        self.detail_item.setLevels(self.imageItem.levels)
+        self.detail_item.setLookupTable(self.imageItem.lut)
+
+    def close(self):
+        self.closed = True
+        self.pool.terminate()
+        super(TiledCrossSectionDock, self).close()
+
+class MoviePlayer(QtCore.QObject):
+    """
+    Plays a MoviePlotDock against the clock: at rate frames of data per second, showing every stride-th frame.
+    Each tick shows the frame due at that time, so when frames cost more than a tick the ones in between are
+    skipped rather than playback falling behind, and ticks are spaced to the measured cost of a frame so the
+    GUI stays responsive. Frames are LUT mapped to images on a worker thread one tick ahead of the one shown,
+    leaving the GUI thread only to draw them.
+    """
+    frame_prepared = QtCore.pyqtSignal(object, object, object)
+    RATES = (1, 2, 5, 10, 20, 30, 60, 120, 240)
+
+    def __init__(self, dock, rate=20, stride=1):
+        super(MoviePlayer, self).__init__()
+        self.dock = dock
+        self.rate = rate
+        self.stride = stride
+        self.playing = False
+        self.generation = 0
+        # The back buffer: the frame prepared for the coming tick by index, while the one shown is drawn
+        self.prepared = {}
+        self.lut = self.levels = None
+        self.transpose = True
+        # Moving averages of the seconds spent preparing and drawing a frame
+        self.prepare_cost = self.draw_cost = 0.
+        self.skipped = 0
+        self.last_step = None
+        self.shown_at = deque(maxlen=1000)
+        self.timer = QtCore.QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.tick)
+        self.frame_prepared.connect(self.store)
+        self.wanted = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def interval(self):
+        'seconds between ticks: one shown frame at the target rate, but no less than a frame costs'
+        return max(self.stride / float(self.rate), 1 / DISPLAY_RATE, self.prepare_cost, self.draw_cost)
+
+    def set_rate(self, rate):
+        self.rate = rate
+        self.restart()
+
+    def set_stride(self, stride):
+        self.stride = max(int(stride), 1)
+        self.restart()
+
+    def start(self):
+        self.playing = True
+        self.restart()
+
+    def stop(self):
+        if not self.playing:
+            return
+        self.playing = False
+        self.timer.stop()
+        self.generation += 1
+        self.prepared.clear()
+        # Shows the frame where playback stopped as usual, so that levels and cross sections act on it again
+        self.dock.redraw_frame()
+
+    def restart(self):
+        'starts the clock again from the current frame, e.g. once the rate or stride is changed'
+        if not self.playing:
+            return
+        self.generation += 1
+        self.prepared.clear()
+        self.t0 = time.time()
+        self.i0 = self.dock.frame_index()
+        self.last_step = 0
+        self.skipped = 0
+        self.shown_at.clear()
+        self.update_lut()
+        self.request(self.due(self.t0))
+        self.timer.start(0)
+
+    def update_lut(self):
+        'takes the lookup table, levels and axis order to map frames with from the image item, on the GUI thread'
+        item = self.dock.imageItem
+        lut = item.lut
+        if callable(lut):
+            lut = lut(item.image)
+        self.lut, self.levels = lut, item.levels
+        # As ImageItem.render does, frames indexed (x, y) are transposed to the row major order of a QImage
+        self.transpose = getattr(item, 'axisOrder', 'col-major') == 'col-major'
+
+    def lut_changed(self, *args):
+        'drops the frames already prepared with the old levels or colors'
+        if self.playing:
+            self.update_lut()
+            self.generation += 1
+            self.prepared.clear()
+            self.request(self.due(time.time() + self.interval()))
+
+    def step(self, t):
+        return int((t - self.t0) * self.rate / self.stride)
+
+    def due(self, t):
+        return (self.i0 + self.step(t) * self.stride) % self.dock.tpts
+
+    @timed('MoviePlayer.tick')
+    def tick(self):
+        t = time.time()
+        step = self.step(t)
+        i = self.due(t)
+        frame = self.prepared.pop(i, None)
+        if frame is None and self.prepared:
+            # The frame due is not ready, the latest one prepared is shown instead of none
+            i = max(self.prepared, key=lambda k: (k - self.i0) % self.dock.tpts)
+            frame = self.prepared.pop(i)
+        self.prepared.clear()
+        interval = self.interval()
+        self.request(self.due(t + interval))
+        if frame is not None:
+            self.show(i, *frame)
+            skipped = max(step - self.last_step - 1, 0)
+            self.skipped += skipped
+            if instruments.enabled:
+                instruments.count('MoviePlayer.skipped', skipped)
+            self.last_step = step
+        self.timer.start(int(1000 * self.interval()))
+
+    @timed('MoviePlayer.show')
+    def show(self, i, data, image):
+        t0 = time.time()
+        item = self.dock.imageItem
+        item.image = data
+        item.qimage = image
+        item.update()
+        self.dock.set_frame_position(i)
+        if self.dock.cross_section_enabled:
+            self.dock.update_cross_section()
+        self.draw_cost = 0.8 * self.draw_cost + 0.2 * (time.time() - t0)
+        self.shown_at.append(t0)
+
+    def request(self, i):
+        with self.condition:
+            self.wanted = (self.generation, i, self.lut, self.levels, self.transpose)
+            self.condition.notify()
+
+    def store(self, generation, i, frame):
+        if generation == self.generation and self.playing:
+            self.prepared[i] = frame
+
+    def close(self):
+        self.timer.stop()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.wanted is None and not self.stopped:
+                    self.condition.wait()
+                if self.stopped:
+                    return
+                generation, i, lut, levels, transpose = self.wanted
+                self.wanted = None
+            t0 = time.time()
+            try:
+                data = np.asarray(self.dock.frames[i])
+                argb, alpha = pg.functions.makeARGB(data.transpose((1, 0, 2)[:data.ndim]) if transpose else data,
+                                                    lut=lut, levels=levels)
+                image = pg.functions.makeQImage(argb, alpha, transpose=False)
+            except Exception as e:
+                warnings.warn('Could not prepare frame %d: %s' % (i, e))
+                continue
+            if self.dock.streaming:
+                self.dock.frames.prefetch([(i + n * self.stride) % self.dock.tpts
+                                           for n in range(1, self.dock.prefetch + 1)])
+            self.prepare_cost = 0.8 * self.prepare_cost + 0.2 * (time.time() - t0)
+            self.frame_prepared.emit(generation, i, (data, image))
 
 class MoviePlotDock(CrossSectionDock):
-    def __init__(self, array, *args, **kwargs):
+    """
+    Plays the frames of a 3D array. If given a frame source such as a FrameCache instead of an array,
+    frames are fetched one at a time and the ones after the current frame are prefetched.
+    """
+    def __init__(self, array, prefetch=8, *args, **kwargs):
         super(MoviePlotDock, self).__init__(*args, **kwargs)
-        self.setImage(array)
+        self.streaming = not isinstance(array, np.ndarray)
+        self.frames = array
+        self.prefetch = prefetch
+        self.current_frame = 0
+        self.image_kwargs = {}
         self.tpts = len(array)
+        self.setImage(array)
         play_button = QtGui.QPushButton("Play")
         stop_button = QtGui.QPushButton("Stop")
         stop_button.hide()
+        if self.streaming:
+            self.frame_slider = QtGui.QSlider(QtCore.Qt.Horizontal)
+            self.frame_slider.setRange(0, self.tpts - 1)
+            self.frame_slider.valueChanged.connect(self.show_frame)
+            self.addWidget(self.frame_slider)
+        self.player = MoviePlayer(self)
+        rate_box = QtGui.QComboBox()
+        for rate in MoviePlayer.RATES:
+            rate_box.addItem('%d fps' % rate, rate)
+        rate_box.setCurrentIndex(MoviePlayer.RATES.index(self.player.rate))
+        rate_box.currentIndexChanged.connect(lambda i: self.player.set_rate(MoviePlayer.RATES[i]))
+        stride_box = QtGui.QSpinBox()
+        stride_box.setRange(1, max(self.tpts - 1, 1))
+        stride_box.setPrefix('every ')
+        stride_box.setSuffix(' frames')
+        stride_box.valueChanged.connect(self.player.set_stride)
         self.addWidget(play_button)
         self.addWidget(stop_button)
-        self.play_timer = QtCore.QTimer()
-        self.play_timer.setInterval(50)
-        self.play_timer.timeout.connect(self.increment)
-        play_button.clicked.connect(self.play_timer.start)
+        self.addWidget(rate_box)
+        self.addWidget(stride_box)
+        play_button.clicked.connect(self.player.start)
         play_button.clicked.connect(play_button.hide)
         play_button.clicked.connect(stop_button.show)
-        stop_button.clicked.connect(self.play_timer.stop)
+        stop_button.clicked.connect(self.player.stop)
         stop_button.clicked.connect(play_button.show)
         stop_button.clicked.connect(stop_button.hide)
+        self.ui.histogram.item.sigLevelsChanged.connect(self.player.lut_changed)
+        self.ui.histogram.item.sigLookupTableChanged.connect(self.player.lut_changed)
+
+    def setImage(self, array, **kwargs):
+        if not self.streaming:
+            return super(MoviePlotDock, self).setImage(array, **kwargs)
+        self.image_kwargs = kwargs
+        self.show_frame(self.current_frame, autoLevels=True)
+
+    def level_source(self):
+        return self.frames.dataset if self.streaming else None
+
+    def show_frame(self, i, autoLevels=False):
+        self.current_frame = i
+        kwargs = dict(self.image_kwargs, autoRange=autoLevels, autoLevels=autoLevels)
+        super(MoviePlotDock, self).setImage(self.frames[i], **kwargs)
+        self.frames.prefetch([(i + n) % self.tpts for n in range(1, self.prefetch + 1)])
+
+    def append_frames(self, frames):
+        index = self.img_view.currentIndex
+        self.append_rows(frames)
+        self.frames = self.img_view.image
+        self.tpts = len(self.frames)
+        self.img_view.setCurrentIndex(index)
+
+    def extend(self, n):
+        'follows a streamed dataset as it grows to n frames'
+        self.frames.grow(n)
+        self.tpts = n
+        self.frame_slider.setRange(0, n - 1)
+
+    def frame_index(self):
+        return self.current_frame if self.streaming else self.img_view.currentIndex
+
+    def set_frame_position(self, i):
+        'moves the slider or time line to frame i, which the player has drawn itself'
+        self.current_frame = i
+        if self.streaming:
+            slider = self.frame_slider
+        else:
+            self.img_view.currentIndex = i
+            slider = self.img_view.timeLine
+            i = self.img_view.tVals[i]
+        slider.blockSignals(True)
+        slider.setValue(i)
+        slider.blockSignals(False)
+
+    def redraw_frame(self):
+        'draws the current frame the usual way, with levels and cross sections acting on it'
+        if self.streaming:
+            self.show_frame(self.current_frame)
+        else:
+            self.img_view.setCurrentIndex(self.img_view.currentIndex)
 
-    def increment(self):
-        self.img_view.setCurrentIndex((self.img_view.currentIndex + 1) % self.tpts)
-
-
+    def close(self):
+        self.player.close()
+        if self.streaming:
+            self.frames.stop()
+        super(MoviePlotDock, self).close()
@@ -0,0 +1,132 @@
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
+import logging
+import threading
+import time
+import numpy as np
+from PyQt4 import QtCore
+from data_sources import block_shape, blocks
+
+
+class Statistics(namedtuple('Statistics', 'count nan_count min max mean histogram edges')):
+    'summary of a dataset: min, max, mean and histogram are over its finite values, count is how many there are'
+
+
+def statistics_supported(dataset):
+    return dataset.dtype.kind in 'biuf'
+
+
+def block_statistics(data, bins=64):
+    'the statistics of one block, with a histogram over the range of the block itself'
+    data = np.asarray(data, dtype=float).ravel()
+    nan_count = int(np.isnan(data).sum())
+    finite = data[np.isfinite(data)]
+    if not finite.size:
+        return Statistics(0, nan_count, None, None, 0., None, None)
+    lo, hi = finite.min(), finite.max()
+    counts, edges = np.histogram(finite, bins, (lo, hi))
+    return Statistics(finite.size, nan_count, lo, hi, finite.sum(), counts, edges)
+
+
+def merge_statistics(partials, bins=16):
+    """
+    combines the statistics of the blocks of a dataset, whose means are still sums.
+    The block histograms are rebinned onto the full range by their bin centers, which is exact to within a block bin
+    """
+    nan_count = sum(p.nan_count for p in partials)
+    partials = [p for p in partials if p.count]
+    if not partials:
+        return Statistics(0, nan_count, None, None, None, np.zeros(bins, dtype=int), None)
+    count = sum(p.count for p in partials)
+    lo, hi = min(p.min for p in partials), max(p.max for p in partials)
+    centers = np.concatenate([(p.edges[:-1] + p.edges[1:]) / 2 for p in partials])
+    weights = np.concatenate([p.histogram for p in partials])
+    histogram, edges = np.histogram(np.clip(centers, lo, hi), bins, (lo, hi), weights=weights)
+    return Statistics(count, nan_count, lo, hi, sum(p.mean for p in partials) / count, histogram.astype(int), edges)
+
+
+class IOBudget(object):
+    'limits the rate at which background work reads, to bytes_per_second averaged over about a second'
+    def __init__(self, bytes_per_second):
+        self.rate = float(bytes_per_second)
+        self.available = self.rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def spend(self, nbytes):
+        'waits until nbytes may be read'
+        with self.lock:
+            now = time.time()
+            self.available = min(self.available + (now - self.updated) * self.rate, self.rate) - nbytes
+            self.updated = now
+            wait = -self.available / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def dataset_statistics(dataset, pool, budget=None, cancelled=lambda: False, block_bytes=2**24):
+    """
+    the Statistics of a numeric dataset, reducing it chunk by chunk in parallel on pool, in blocks of whole chunks
+    of at most block_bytes once converted to float, or None if cancelled() becomes true first
+    """
+    if not dataset.shape:
+        return merge_statistics([block_statistics(dataset[()])])
+    shape = block_shape(dataset.shape, dataset.chunks, max(dataset.dtype.itemsize, 8), block_bytes)
+
+    def reduce_block(selection):
+        if cancelled():
+            return None
+        if budget is not None:
+            budget.spend(int(np.prod([s.stop - s.start for s in selection])) * dataset.dtype.itemsize)
+        return block_statistics(dataset[selection])
+    partials = pool.map(reduce_block, list(blocks(dataset.shape, shape)))
+    if cancelled() or any(p is None for p in partials):
+        return None
+    return merge_statistics(partials)
+
+
+class StatisticsWorker(QtCore.QObject):
+    """
+    Computes dataset statistics in the background, one dataset at a time, each over a pool of threads.
+    Results are delivered through statistics_computed, None for a dataset which could not be read.
+    cancel() drops everything requested so far.
+    """
+    statistics_computed = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, budget=None, workers=4):
+        super(StatisticsWorker, self).__init__()
+        self.budget = budget
+        self.pool = ThreadPool(workers)
+        self.generation = 0
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def request(self, key, dataset):
+        with self.condition:
+            self.queue.append((self.generation, key, dataset))
+            self.condition.notify()
+
+    def cancel(self):
+        with self.condition:
+            self.generation += 1
+            self.queue.clear()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                generation, key, dataset = self.queue.popleft()
+            cancelled = lambda: generation != self.generation
+            try:
+                stats = dataset_statistics(dataset, self.pool, self.budget, cancelled)
+                if stats is None:
+                    continue
+            except Exception:
+                logging.exception("Statistics of %s failed", key)
+                stats = None
+            if not cancelled():
+                self.statistics_computed.emit(key, stats)
@@ -0,0 +1,170 @@
+from array import array
+import threading
+import numpy as np
+
+
+class PathIndex(object):
+    """
+    Trigram index over node paths, answering substring queries without scanning every path.
+    Paths are padded so that terms shorter than a trigram can still be found through the grams containing them.
+    Removed paths leave a tombstone behind, their id is never reused.
+    Searches may run on a worker thread while renames arrive from the GUI thread.
+    """
+    PAD = '\0'
+
+    def __init__(self, paths=()):
+        self.paths = []
+        self.ids = {}
+        self.grams = {}
+        self.lock = threading.RLock()
+        for p in paths:
+            self.add(p)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getstate__(self):
+        with self.lock:
+            return {'paths': self.paths, 'ids': self.ids, 'grams': self.grams}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def __contains__(self, path):
+        return path in self.ids
+
+    def add(self, path):
+        with self.lock:
+            self._add(path)
+
+    def _add(self, path):
+        if path in self.ids:
+            return
+        i = len(self.paths)
+        self.paths.append(path)
+        self.ids[path] = i
+        padded = self.PAD + path + self.PAD
+        for g in {padded[j:j+3] for j in range(len(padded) - 2)}:
+            try:
+                self.grams[g].append(i)
+            except KeyError:
+                self.grams[g] = array('i', [i])
+
+    def remove(self, path):
+        with self.lock:
+            i = self.ids.pop(path, None)
+            if i is not None:
+                self.paths[i] = None
+
+    def rename(self, old_path, new_path):
+        'moves a path and everything below it'
+        with self.lock:
+            moved = [p for p in self.search([old_path]) if p == old_path or p.startswith(old_path + '/')]
+            for p in moved:
+                self.remove(p)
+            for p in moved:
+                self._add(new_path + p[len(old_path):])
+
+    def candidates(self, term):
+        'sorted ids of the paths which may contain term'
+        if len(term) >= 3:
+            postings = [self.grams.get(term[j:j+3]) for j in range(len(term) - 2)]
+            if not all(postings):
+                return np.zeros(0, dtype='i')
+            postings.sort(key=len)
+            ids = np.array(postings[0], dtype='i')
+            for p in postings[1:]:
+                ids = np.intersect1d(ids, np.array(p, dtype='i'), assume_unique=True)
+                if not len(ids):
+                    break
+            return ids
+        postings = [np.array(p, dtype='i') for g, p in self.grams.iteritems() if term in g]
+        if not postings:
+            return np.zeros(0, dtype='i')
+        return np.unique(np.concatenate(postings))
+
+    def search(self, terms, cancelled=None):
+        """
+        returns every path containing all of the terms,
+        or None if cancelled() becomes true before the search is done.
+        It is checked often, a rename waiting for the lock cancels the search first
+        """
+        with self.lock:
+            if not terms:
+                return [p for p in self.paths if p is not None]
+            ids = None
+            for t in sorted(terms, key=len, reverse=True):
+                if cancelled is not None and cancelled():
+                    return None
+                c = self.candidates(t)
+                ids = c if ids is None else np.intersect1d(ids, c, assume_unique=True)
+                if not len(ids):
+                    return []
+            paths = []
+            for n, i in enumerate(ids):
+                if cancelled is not None and not n % 4096 and cancelled():
+                    return None
+                p = self.paths[i]
+                if p is not None and all(t in p for t in terms):
+                    paths.append(p)
+            return paths
+
+
+class ShapeIndex(object):
+    """
+    The paths of the 1D datasets by their length, for finding axis scales which fit a dataset.
+    Filled from scan results, so that looking up candidates never touches the file.
+    """
+    def __init__(self):
+        self.by_length = {}
+        self.lengths = {}
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def add(self, path, shape):
+        if shape is None or len(shape) != 1:
+            return
+        with self.lock:
+            self.remove(path)
+            self.lengths[path] = shape[0]
+            self.by_length.setdefault(shape[0], set()).add(path)
+
+    def remove(self, path):
+        with self.lock:
+            n = self.lengths.pop(path, None)
+            if n is not None:
+                self.by_length[n].discard(path)
+
+    def rename(self, old_path, new_path):
+        'moves a path and everything below it'
+        with self.lock:
+            moved = [p for p in self.lengths if p == old_path or p.startswith(old_path + '/')]
+            for p in moved:
+                n = self.lengths[p]
+                self.remove(p)
+                self.add(new_path + p[len(old_path):], (n,))
+
+    def candidates(self, length, near=None):
+        """
+        the paths of the datasets of the given length.
+        If near is a path, they are ordered by the number of steps up and down the hierarchy from it
+        """
+        with self.lock:
+            paths = list(self.by_length.get(length, ()))
+        if near is None:
+            return sorted(paths)
+        return sorted(paths, key=lambda p: (path_distance(near, p), p))
+
+
+def path_distance(a, b):
+    'the number of steps from path a up to the closest common ancestor and down to path b'
+    a, b = a.strip('/').split('/'), b.strip('/').split('/')
+    common = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        common += 1
+    return len(a) + len(b) - 2 * common
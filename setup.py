@@ -13,7 +13,10 @@ setup(
         "py2exe":
             { "includes":
                   ["h5py.defs", "h5py.utils", "h5py._proxy", "h5py.h5ac",
-                   "scipy.sparse.csgraph._validation", "scipy.special._ufuncs_cxx"],
+                   # Compiled scipy modules which py2exe does not find by itself
+                   "scipy.sparse.csgraph._validation", "scipy.special._ufuncs_cxx", "scipy.stats.futil",
+                   # Imported only once the first plot is made
+                   "pyqtgraph.dockarea", "plot_widgets", "data_sources", "scipy.spatial.ckdtree"],
               "dll_excludes":["MSVCP90.dll", "libzmq.pyd"]  }
     }
 )
\ No newline at end of file
@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+import __builtin__
+import sys
+import time
+
+
+class StartupProfile(object):
+    """
+    Records how long each module import and each startup phase takes, for --profile-startup.
+    Imports are timed by wrapping __import__, so this has to be created before the imports it should see.
+    When disabled, phase() does nothing and no hook is installed.
+    """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.start = time.time()
+        self.imports = []
+        self.phases = []
+        self.depth = 0
+        if enabled:
+            self.original_import = __builtin__.__import__
+            __builtin__.__import__ = self.timed_import
+
+    def timed_import(self, name, *args, **kwargs):
+        if name in sys.modules:
+            return self.original_import(name, *args, **kwargs)
+        depth = self.depth
+        self.depth += 1
+        t0 = time.time()
+        try:
+            return self.original_import(name, *args, **kwargs)
+        finally:
+            self.depth = depth
+            if name in sys.modules:
+                self.imports.append((t0, depth, name, time.time() - t0))
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.phases.append((name, time.time() - t0))
+
+    def report(self, stream=sys.stderr, min_time=0.001):
+        'prints the imports taking at least min_time seconds, nested under their importer, then the phases'
+        if not self.enabled:
+            return
+        __builtin__.__import__ = self.original_import
+        stream.write("Imports (cumulative ms):\n")
+        for _, depth, name, duration in sorted(self.imports):
+            if duration >= min_time:
+                stream.write("%8.1f %s%s\n" % (duration * 1000, '  ' * depth, name))
+        stream.write("Phases (ms):\n")
+        for name, duration in self.phases:
+            stream.write("%8.1f %s\n" % (duration * 1000, name))
+        stream.write("%8.1f total until first event\n" % ((time.time() - self.start) * 1000))
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import glob
+import logging
+import os
+import h5py
+
+H5_EXTENSIONS = ('.h5', '.hdf5', '.hdf', '.he5', '.nxs')
+
+
+def is_workspace(pattern):
+    'whether a command line argument names a directory or glob of files rather than a single file'
+    return os.path.isdir(pattern) or glob.has_magic(pattern)
+
+
+def workspace_files(pattern):
+    'the HDF5 files in a directory, or the files matching a glob pattern, sorted'
+    if os.path.isdir(pattern):
+        return sorted(os.path.join(pattern, fn) for fn in os.listdir(pattern)
+                      if os.path.splitext(fn)[1].lower() in H5_EXTENSIONS)
+    return sorted(fn for fn in glob.glob(pattern) if os.path.isfile(fn))
+
+
+def file_labels(filenames):
+    'a name for each file to show at the top level of a workspace, its base name unless that is ambiguous'
+    names = [os.path.basename(fn) for fn in filenames]
+    counts = {}
+    for n in names:
+        counts[n] = counts.get(n, 0) + 1
+    return {fn: n if counts[n] == 1 else os.path.normpath(fn).replace(os.sep, '_')
+            for fn, n in zip(filenames, names)}
+
+
+class FileHandles(object):
+    """
+    Opens files when first used and keeps at most max_open of them open, closing the least recently used first.
+    Pinned files, e.g. those being plotted, are never closed. on_close(filename) is called before a file is closed,
+    as every object opened from it becomes invalid.
+    With a MetadataCache, files are opened and closed through it, so that doing so does not invalidate their entries.
+    """
+    def __init__(self, max_open=64, on_close=None, swmr=False, metadata_cache=None):
+        self.max_open = max_open
+        self.on_close = on_close
+        self.swmr = swmr
+        self.metadata_cache = metadata_cache
+        self.files = OrderedDict()
+        self.pins = {}
+        # Handles replaced by reopen() while pinned, closed once unpinned
+        self.retired = {}
+
+    def open(self, filename):
+        open_file = h5py.File if self.metadata_cache is None else self.metadata_cache.open_file
+        if self.swmr:
+            return open_file(filename, 'r', libver='latest', swmr=True)
+        try:
+            return open_file(filename, 'r+')
+        except IOError:
+            return open_file(filename, 'r')
+
+    def close_handle(self, f):
+        if self.metadata_cache is None:
+            f.close()
+        else:
+            self.metadata_cache.close_file(f)
+
+    def get(self, filename):
+        f = self.files.pop(filename, None)
+        if f is None:
+            f = self.open(filename)
+        self.files[filename] = f
+        self.evict()
+        return f
+
+    def reopen(self, filename):
+        'a new handle on filename, e.g. after it was written to. The old one is closed once it is no longer pinned'
+        old = self.files.pop(filename, None)
+        if old is not None:
+            if self.pins.get(filename):
+                self.retired.setdefault(filename, []).append(old)
+            else:
+                self.close_handle(old)
+        return self.get(filename)
+
+    def evict(self):
+        'closes the least recently used files over max_open, never the one just used'
+        for filename in list(self.files)[:-1]:
+            if len(self.files) <= self.max_open:
+                return
+            if not self.pins.get(filename):
+                self.close(filename)
+
+    def close(self, filename):
+        f = self.files.get(filename)
+        if f is None or self.pins.get(filename):
+            return
+        if self.on_close is not None:
+            try:
+                self.on_close(filename)
+            except Exception:
+                logging.exception("Could not release %s", filename)
+        del self.files[filename]
+        self.close_handle(f)
+
+    def pin(self, filename):
+        self.pins[filename] = self.pins.get(filename, 0) + 1
+
+    def unpin(self, filename):
+        self.pins[filename] -= 1
+        if not self.pins[filename]:
+            del self.pins[filename]
+            for f in self.retired.pop(filename, []):
+                self.close_handle(f)
+            self.evict()
+
+    def close_all(self):
+        'closes every file, pinned or not, e.g. on exit'
+        self.pins = {}
+        for filename in list(self.files):
+            self.close(filename)
+        for handles in self.retired.values():
+            for f in handles:
+                self.close_handle(f)
+        self.retired = {}
+
+    def __len__(self):
+        return len(self.files)